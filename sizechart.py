@@ -1,14 +1,31 @@
 from xml.etree import ElementTree as ET
-import array
+import abc
 import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import math
 import glob
+import heapq
+import hashlib
+import io
+import itertools
+import marshal
+import multiprocessing
+from multiprocessing import shared_memory
 import traceback
 import os
 import operator
+import struct
+import threading
+import tempfile
 import time
+import zlib
 from enum import Enum, auto
 from ctypes import byref
+from xml.sax.saxutils import escape
 
 import pyglet
 from pyglet.gl import *
@@ -37,6 +54,87 @@ NS = {
 def ns(n, t):
     return f'{{{NS[n]}}}{t}'
 
+# Namespaced names, each built by ns() only once: SC.scale == ns('sizechart', 'scale')
+class Keys:
+    def __init__(self, n):
+        self.n = n
+
+    def __getattr__(self, t):
+        key = ns(self.n, t)
+        setattr(self, t, key)
+        return key
+
+SC, SVG, XLINK = Keys('sizechart'), Keys('svg'), Keys('xlink')
+
+# Parses source incrementally. Returns the root, which has its attributes but
+# no children, and an iterator over those children. Each child is dropped as
+# soon as the caller moves on, so the whole tree is never in memory.
+def iter_children(source):
+    events = ET.iterparse(source, ('start', 'end'))
+    _, root = next(events)
+    def children():
+        depth = 1
+        for event, elem in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield elem
+                # Only the finished child; the root keeps its attributes
+                root.remove(elem)
+    return root, children()
+
+# Takes the same start/data/end calls as ET.TreeBuilder, but writes each
+# element to the file as it goes instead of building a tree; only the names of
+# the open elements are kept. Namespaces get the prefixes from NS, declared on
+# the root element.
+class SVGWriter:
+    ATTR = {'"': '&quot;', '\n': '&#10;', '\t': '&#9;'}
+
+    def __init__(self, f):
+        self.f = f
+        self.prefixes = {uri: p for p, uri in NS.items()}
+        self.stack = []
+        self.pending = False
+
+    def qname(self, name):
+        if name.startswith('{'):
+            uri, local = name[1:].split('}', 1)
+            return f'{self.prefixes[uri]}:{local}'
+        return name
+
+    def flush_start(self):
+        if self.pending:
+            self.f.write('>\n' if len(self.stack) == 1 else '>')
+            self.pending = False
+
+    def start(self, tag, attrs):
+        self.flush_start()
+        name = self.qname(tag)
+        parts = [f'<{name}']
+        if not self.stack:
+            parts.extend(f' xmlns:{p}="{uri}"' for uri, p in self.prefixes.items())
+        for k, v in attrs.items():
+            parts.append(f' {self.qname(k)}="{escape(v, self.ATTR)}"')
+        self.f.write(''.join(parts))
+        self.stack.append(name)
+        self.pending = True
+
+    def data(self, text):
+        self.flush_start()
+        self.f.write(escape(text))
+
+    def end(self, tag):
+        name = self.stack.pop()
+        if self.pending:
+            self.f.write(' />')
+            self.pending = False
+        else:
+            self.f.write(f'</{name}>')
+        if len(self.stack) <= 1:
+            self.f.write('\n')
+
 SCALE = ' kMG'
 def si(n):
     unit = 0
@@ -47,11 +145,14 @@ def si(n):
 
 CURSOR = '|'
 
-def steps(origin, width, bias = 0.25):
+def grid_step(width, bias = 0.25):
     try:
-        step = 10 ** (int(math.log(width, 10) - bias))
+        return 10 ** (int(math.log(width, 10) - bias))
     except ValueError:
-        step = 1
+        return 1
+
+def steps(origin, width, bias = 0.25):
+    step = grid_step(width, bias)
     nearest = int(origin / step) * step
     x = nearest
     while x <= origin+width:
@@ -73,26 +174,9 @@ def mod_for(k):
         return key.MOD_WINDOWS
     return 0
 
-def mean(seq, lim=1024):
-    def inner(s):
-        runtot = 0
-        count = 0
-        for elem in s:
-            runtot += elem
-            count += 1
-            if count >= lim:
-                yield (runtot, count)
-                runtot = 0
-                count = 0
-        yield (runtot, count)
-
-    subsum = tuple(inner(seq))
-    depth = 1
-    while len(subsum) > 1:
-        subsum = tuple(inner(a / b for a, b in subsum))
-        depth += 1
-
-    return subsum[0][0] / subsum[0][1], depth
+def file_key(path):
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_mtime_ns, st.st_size)
 
 class RenderState(Enum):
     NORMAL = auto()
@@ -138,11 +222,1836 @@ class Vec2:
     def __ne__(self, rhs):
         return not (self == rhs)
 
+AVG_SAMPLES = 1 << 20
+def rgba_average(buffer, w, h, ign_transp=True):
+    # Sample every step'th pixel on large images; keeping the step coprime
+    # with the width walks the columns instead of striping one of them.
+    step = max(1, (w * h) // AVG_SAMPLES)
+    if step > 1:
+        while math.gcd(step, w) != 1:
+            step += 1
+    stride = 4 * step
+    alpha = buffer[3::stride]
+    if ign_transp:
+        count = len(alpha) - alpha.count(0)
+        sums = [sum(itertools.compress(buffer[c::stride], alpha)) for c in range(3)]
+    else:
+        count = len(alpha)
+        sums = [sum(buffer[c::stride]) for c in range(3)]
+    if not count:
+        return (0, 0, 0)
+    return tuple(int(i / count) for i in sums)
+
+THUMB = 64
+# What the info cache keeps about an image, from its RGBA pixels (bottom row
+# first, as pyglet has them): size, average color, the bounds (left, bottom,
+# right, top) of its non-transparent pixels or None, and a thumbnail no bigger
+# than THUMB on a side as (width, height, pixels).
+def image_info(pixels, w, h):
+    alpha = pixels[3::4]
+    rows = []
+    left, right = w, 0
+    for r in range(h):
+        row = alpha[r * w:(r + 1) * w]
+        rest = row.lstrip(b'\0')
+        if rest:
+            rows.append(r)
+            left = min(left, w - len(rest))
+            right = max(right, len(row.rstrip(b'\0')))
+    bounds = (left, rows[0], right, rows[-1] + 1) if rows else None
+    f = max(1.0, w / THUMB, h / THUMB)
+    tw, th = max(1, round(w / f)), max(1, round(h / f))
+    cols = [(c * w // tw) * 4 for c in range(tw)]
+    thumb = []
+    for r in range(th):
+        start = (r * h // th) * w * 4
+        row = pixels[start:start + w * 4]
+        thumb.append(b''.join(row[c:c + 4] for c in cols))
+    return {
+        'size': (w, h),
+        'avg': rgba_average(pixels, w, h),
+        'bounds': bounds,
+        'thumb': (tw, th, b''.join(thumb)),
+    }
+
+# Runs in the decoder pool, so it must return plain data and touch no GL.
+def decode_image(path, derive=False, known=frozenset()):
+    key = file_key(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if digest in known:
+        return key, digest, None
+    img = pyglet.image.load(path, file=io.BytesIO(data)).get_image_data()
+    w, h = img.width, img.height
+    pixels = img.get_data('RGBA', w * 4)
+    if not isinstance(pixels, bytes):
+        pixels = bytes(pixels)
+    info = image_info(pixels, w, h) if derive else None
+    return key, digest, (w, h, pixels, info)
+
+# decode_image for the decoder pool: the pixels come back through shared
+# memory, as (name, length) for take_shared(), rather than down the pool's pipe
+def decode_shared(path, derive=False):
+    key, digest, (w, h, pixels, info) = decode_image(path, derive)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, len(pixels)))
+    shm.buf[:len(pixels)] = pixels
+    shm.close()
+    return key, digest, (w, h, (shm.name, len(pixels)), info)
+
+def take_shared(shared):
+    name, n = shared
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:n])
+    finally:
+        shm.close()
+        shm.unlink()
+
+# Also for the decoder pool, when only the info is wanted
+def derive_image(path):
+    key, digest, (w, h, pixels, info) = decode_image(path, True)
+    return key, digest, info
+
+_decoders = None
+def decoders():
+    global _decoders
+    if _decoders is None:
+        os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+        _decoders = concurrent.futures.ProcessPoolExecutor(
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+    return _decoders
+
+# Encoding (zlib lets go of the GIL) happens on threads
+_encoders = None
+def encoders():
+    global _encoders
+    if _encoders is None:
+        _encoders = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+    return _encoders
+
+# Drives a job (see Jobs) to the end right here, waiting on whatever it waits on
+def run_job(gen):
+    try:
+        step = next(gen)
+        while True:
+            if isinstance(step, concurrent.futures.Future):
+                try:
+                    res = step.result()
+                except Exception as e:
+                    step = gen.throw(e)
+                    continue
+                step = gen.send(res)
+            else:
+                step = next(gen)
+    except StopIteration as stop:
+        return stop.value
+
+# A job that waits on each of futs, reporting how many are done
+def wait_all(futs):
+    results = []
+    for i, fut in enumerate(futs):
+        results.append((yield fut))
+        yield (i + 1) / len(futs)
+    return results
+
+# Through a temporary file, so a reader sees the old text or the new, never
+# half of it
+def write_text(path, text):
+    fd, tmp = tempfile.mkstemp(
+        prefix=f'.{os.path.basename(path)}.', suffix='.tmp',
+        dir=os.path.dirname(os.path.abspath(path)),
+    )
+    try:
+        with open(fd, 'w') as f:
+            f.write(text)
+        mode = os.stat(path).st_mode if os.path.exists(path) else 0o644
+        os.chmod(tmp, mode & 0o777)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+# A chart's sidecar (chart.svg.cache) is a marshalled, deflated snapshot of
+# what loading it produced. It stays good as long as the chart and every file
+# it refers to keep the same mtime and size they had when the snapshot was
+# taken (see App.snapshot).
+SIDECAR_MAGIC = b'SZCC\x01'
+
+def sidecar_path(path):
+    return path + '.cache'
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def read_sidecar(path):
+    try:
+        with open(sidecar_path(path), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if not data.startswith(SIDECAR_MAGIC):
+        return None
+    try:
+        snap = marshal.loads(zlib.decompress(data[len(SIDECAR_MAGIC):]))
+    except (ValueError, EOFError, TypeError, zlib.error):
+        return None
+    for dep, stamp in snap['deps']:
+        if file_stamp(dep) != stamp:
+            print(f'Sidecar stale: {dep}')
+            return None
+    return snap
+
+def write_sidecar(path, snap):
+    target = sidecar_path(path)
+    try:
+        fd, tmp = tempfile.mkstemp(
+            prefix=f'.{os.path.basename(target)}.', suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(target)),
+        )
+    except OSError as e:
+        print(f'Sidecar not written: {e}')
+        return
+    try:
+        with open(fd, 'wb') as f:
+            f.write(SIDECAR_MAGIC)
+            f.write(zlib.compress(marshal.dumps(snap), 1))
+        os.replace(tmp, target)
+    except OSError as e:
+        print(f'Sidecar not written: {e}')
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+
+# Runs what's submitted to it one at a time, in order, on a shared pool; lets
+# many files be written at once without any one of them going out of order.
+class SerialQueue:
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.busy = False
+
+    def submit(self, fn, *args):
+        fut = concurrent.futures.Future()
+        with self.lock:
+            self.queue.append((fut, fn, args))
+            if self.busy:
+                return fut
+            self.busy = True
+        self.pool.submit(self.drain)
+        return fut
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.busy = False
+                    return
+                fut, fn, args = self.queue.popleft()
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                fut.set_result(fn(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+
+# Deflating strips of one image happens on its own threads, so the encoders
+# waiting on them can never starve them
+_deflaters = None
+def deflaters():
+    global _deflaters
+    if _deflaters is None:
+        _deflaters = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+    return _deflaters
+
+# Deflates one strip of a zlib stream on its own, the way pigz does: primed
+# with the tail of the strip before it, and ended with a sync flush so the
+# next strip's output can follow straight on.
+def deflate_strip(data, level, prior=b''):
+    if prior:
+        z = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=prior)
+    else:
+        z = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH), zlib.adler32(data), len(data)
+
+# The Adler-32 of a + b, from the Adler-32s of a and b and b's length (as in
+# zlib's adler32_combine)
+ADLER_BASE = 65521
+def adler32_combine(a1, a2, len2):
+    rem = len2 % ADLER_BASE
+    sum1 = a1 & 0xffff
+    sum2 = rem * sum1 % ADLER_BASE
+    sum1 += (a2 & 0xffff) + ADLER_BASE - 1
+    sum2 += (a1 >> 16) + (a2 >> 16) + ADLER_BASE - rem
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+# Image files written a band of rows at a time, so the whole image never has
+# to be in memory. Rows go top to bottom, each width * 4 bytes of RGBA.
+class ImageWriter(abc.ABC):
+    def __init__(self, path, width, height, pool=None):
+        self.width, self.height = width, height
+        self.rows = 0
+        self.f = open(path, 'wb')
+
+    def __enter__(self):
+        return self
+
+    # A writer that fails part way leaves no half-written file behind
+    def __exit__(self, tp, val, tb):
+        if tp is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_rows(self, rows):
+        stride = 4 * self.width
+        rows = list(rows)
+        for row in rows:
+            if len(row) != stride:
+                raise ValueError(f'row is {len(row)} bytes, expected {stride}')
+        self.rows += len(rows)
+        if self.rows > self.height:
+            raise ValueError(f'{self.rows} rows written to a {self.height} row image')
+        self.encode(rows)
+
+    @abc.abstractmethod
+    def encode(self, rows):
+        pass
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.f.name)
+
+    def close(self):
+        if self.rows != self.height:
+            self.f.close()
+            raise ValueError(f'only {self.rows} of {self.height} rows written')
+        self.finish()
+        self.f.close()
+
+# Given a pool, rows are cut into strips that are deflated in parallel and
+# stitched into the one zlib stream PNG wants.
+class PNGWriter(ImageWriter):
+    SIGNATURE = b'\x89PNG\r\n\x1a\n'
+    CHUNK = 1 << 18
+    LEVEL = 6
+    STRIP = 1 << 21
+    WINDOW = 1 << 15
+
+    def __init__(self, path, width, height, level=None, pool=None):
+        super().__init__(path, width, height)
+        self.level = self.LEVEL if level is None else level
+        self.pool = pool
+        self.pending = []
+        self.npending = 0
+        if pool is None:
+            self.z = zlib.compressobj(self.level)
+        else:
+            self.strips = collections.deque()
+            self.ahead = 2 * (os.cpu_count() or 1)
+            self.adler = 1
+            self.prior = b''
+        self.f.write(self.SIGNATURE)
+        self.chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        if pool is not None:
+            self.idat(self.zlib_header(self.level))
+
+    @staticmethod
+    def zlib_header(level):
+        cmf = 0x78
+        flg = (0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3) << 6
+        flg += 31 - (cmf * 256 + flg) % 31
+        return bytes((cmf, flg))
+
+    def chunk(self, tag, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+    def idat(self, data, flush=False):
+        if data:
+            self.pending.append(data)
+            self.npending += len(data)
+        if self.pending and (flush or self.npending >= self.CHUNK):
+            self.chunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.npending = 0
+
+    def encode(self, rows):
+        out = bytearray()
+        for row in rows:
+            out += b'\0'
+            out += row
+        if self.pool is None:
+            self.idat(self.z.compress(out))
+            return
+        for i in range(0, len(out), self.STRIP):
+            strip = bytes(out[i:i + self.STRIP])
+            self.strips.append(self.pool.submit(deflate_strip, strip, self.level, self.prior))
+            self.prior = strip[-self.WINDOW:]
+            self.drain(self.ahead)
+
+    # Writes out finished strips in order, waiting on them while more than
+    # keep are outstanding
+    def drain(self, keep=0):
+        while len(self.strips) > keep or (self.strips and self.strips[0].done()):
+            data, adler, n = self.strips.popleft().result()
+            self.adler = adler32_combine(self.adler, adler, n)
+            self.idat(data)
+
+    def abort(self):
+        if self.pool is not None:
+            for fut in self.strips:
+                fut.cancel()
+        super().abort()
+
+    def finish(self):
+        if self.pool is None:
+            self.idat(self.z.flush(), True)
+        else:
+            self.drain()
+            # An empty final block, then the checksum of everything
+            last = zlib.compressobj(self.level, zlib.DEFLATED, -15).flush()
+            self.idat(last + struct.pack('>I', self.adler), True)
+        self.chunk(b'IEND', b'')
+
+# The framebuffer bytes as they are, after a 12 byte header: RGBA and the
+# width and height (big-endian)
+class RawWriter(ImageWriter):
+    MAGIC = b'RGBA'
+
+    def __init__(self, path, width, height, pool=None):
+        super().__init__(path, width, height)
+        self.f.write(self.MAGIC + struct.pack('>II', width, height))
+
+    def encode(self, rows):
+        self.f.write(b''.join(rows))
+
+# Netpbm PAM, RGBA
+class PAMWriter(ImageWriter):
+    def __init__(self, path, width, height, pool=None):
+        super().__init__(path, width, height)
+        self.f.write(
+            f'P7\nWIDTH {width}\nHEIGHT {height}\nDEPTH 4\nMAXVAL 255\n'
+            f'TUPLTYPE RGB_ALPHA\nENDHDR\n'.encode('ascii')
+        )
+
+    def encode(self, rows):
+        self.f.write(b''.join(rows))
+
+# Netpbm PPM, which has no alpha; it's dropped
+class PPMWriter(ImageWriter):
+    def __init__(self, path, width, height, pool=None):
+        super().__init__(path, width, height)
+        self.f.write(f'P6\n{width} {height}\n255\n'.encode('ascii'))
+
+    def encode(self, rows):
+        data = b''.join(rows)
+        rgb = bytearray(len(data) // 4 * 3)
+        for c in range(3):
+            rgb[c::3] = data[c::4]
+        self.f.write(rgb)
+
+# QOI (qoiformat.org): far cheaper to write than PNG, and usually within a
+# factor of two of its size. The state carries over from one band to the next.
+class QOIWriter(ImageWriter):
+    MAGIC = b'qoif'
+    END = b'\0' * 7 + b'\1'
+
+    def __init__(self, path, width, height, pool=None):
+        super().__init__(path, width, height)
+        self.f.write(self.MAGIC + struct.pack('>IIBB', width, height, 4, 0))
+        self.prev = (0, 0, 0, 255)
+        self.index = [None] * 64
+        self.run = 0
+
+    def encode(self, rows):
+        data = b''.join(rows)
+        out = bytearray()
+        prev, index, run = self.prev, self.index, self.run
+        pr, pg, pb, pa = prev
+        it = iter(data)
+        for px in zip(it, it, it, it):
+            if px == prev:
+                run += 1
+                if run == 62:
+                    out.append(0xc0 | 61)
+                    run = 0
+                continue
+            if run:
+                out.append(0xc0 | (run - 1))
+                run = 0
+            r, g, b, a = px
+            h = (r * 3 + g * 5 + b * 7 + a * 11) & 63
+            if index[h] == px:
+                out.append(h)
+            else:
+                index[h] = px
+                if a == pa:
+                    dr = (r - pr + 128 & 0xff) - 128
+                    dg = (g - pg + 128 & 0xff) - 128
+                    db = (b - pb + 128 & 0xff) - 128
+                    if -2 <= dr <= 1 and -2 <= dg <= 1 and -2 <= db <= 1:
+                        out.append(0x40 | (dr + 2) << 4 | (dg + 2) << 2 | (db + 2))
+                    elif -32 <= dg <= 31 and -8 <= dr - dg <= 7 and -8 <= db - dg <= 7:
+                        out.append(0x80 | (dg + 32))
+                        out.append((dr - dg + 8) << 4 | (db - dg + 8))
+                    else:
+                        out += bytes((0xfe, r, g, b))
+                else:
+                    out += bytes((0xff, r, g, b, a))
+            prev = px
+            pr, pg, pb, pa = px
+        self.prev, self.run = prev, run
+        self.f.write(out)
+
+    def finish(self):
+        if self.run:
+            self.f.write(bytes((0xc0 | (self.run - 1),)))
+        self.f.write(self.END)
+
+WRITERS = {
+    '.png': PNGWriter,
+    '.rgba': RawWriter,
+    '.pam': PAMWriter,
+    '.ppm': PPMWriter,
+    '.qoi': QOIWriter,
+}
+
+def writer_for(path):
+    return WRITERS.get(os.path.splitext(path)[1].lower())
+
+# Reads back anything the writers above write (but PNG), as
+# (width, height, rows); rows yields each row as RGBA, top to bottom.
+# Rows are read from f lazily, so keep it open until they've been used
+def read_image(f):
+    magic = f.read(4)
+    if magic == RawWriter.MAGIC:
+        w, h = struct.unpack('>II', f.read(8))
+        return w, h, (f.read(4 * w) for _ in range(h))
+    if magic == QOIWriter.MAGIC:
+        w, h, _, _ = struct.unpack('>IIBB', f.read(10))
+        return w, h, qoi_rows(f, w, h)
+    if magic[:2] in (b'P6', b'P7'):
+        f.seek(0)
+        return netpbm_rows(f)
+    raise ValueError(f'{f.name}: not an image sizechart wrote')
+
+def netpbm_rows(f):
+    kind = f.readline().strip()
+    if kind == b'P7':
+        fields = {}
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f'{f.name}: PAM header cut short')
+            line = line.strip()
+            if line == b'ENDHDR':
+                break
+            key, _, val = line.partition(b' ')
+            fields[key] = val
+        w, h, depth = (int(fields[k]) for k in (b'WIDTH', b'HEIGHT', b'DEPTH'))
+    else:
+        tokens = []
+        while len(tokens) < 3:
+            line = f.readline()
+            if not line:
+                raise ValueError(f'{f.name}: PPM header cut short')
+            tokens.extend(line.split(b'#')[0].split())
+        w, h, _ = (int(t) for t in tokens)
+        depth = 3
+    def rows():
+        for _ in range(h):
+            row = f.read(depth * w)
+            if depth == 4:
+                yield row
+            else:
+                rgba = bytearray(b'\xff' * (4 * w))
+                for c in range(3):
+                    rgba[c::4] = row[c::3]
+                yield bytes(rgba)
+    return w, h, rows()
+
+def qoi_rows(f, w, h):
+    data = f.read()
+    pos = 0
+    px = (0, 0, 0, 255)
+    index = [(0, 0, 0, 0)] * 64
+    run = 0
+    for _ in range(h):
+        row = bytearray()
+        for _ in range(w):
+            if run:
+                run -= 1
+            else:
+                b1 = data[pos]
+                pos += 1
+                r, g, b, a = px
+                if b1 == 0xfe:
+                    r, g, b = data[pos:pos + 3]
+                    pos += 3
+                elif b1 == 0xff:
+                    r, g, b, a = data[pos:pos + 4]
+                    pos += 4
+                elif b1 >> 6 == 0:
+                    r, g, b, a = index[b1]
+                elif b1 >> 6 == 1:
+                    r = (r + (b1 >> 4 & 3) - 2) & 0xff
+                    g = (g + (b1 >> 2 & 3) - 2) & 0xff
+                    b = (b + (b1 & 3) - 2) & 0xff
+                elif b1 >> 6 == 2:
+                    b2 = data[pos]
+                    pos += 1
+                    dg = (b1 & 63) - 32
+                    r = (r + dg - 8 + (b2 >> 4)) & 0xff
+                    g = (g + dg) & 0xff
+                    b = (b + dg - 8 + (b2 & 15)) & 0xff
+                else:
+                    run = b1 & 63
+                px = (r, g, b, a)
+                index[(r * 3 + g * 5 + b * 7 + a * 11) & 63] = px
+            row += bytes(px)
+        yield bytes(row)
+
+# Turns renders in the fast formats into PNGs alongside them
+def convert_to_png(paths, level=None):
+    for path in paths:
+        out = os.path.splitext(path)[0] + '.png'
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as f:
+                w, h, rows = read_image(f)
+                with PNGWriter(out, w, h, level, deflaters()) as png:
+                    band = []
+                    for row in rows:
+                        band.append(row)
+                        if len(band) == 256:
+                            png.write_rows(band)
+                            band = []
+                    if band:
+                        png.write_rows(band)
+        except Exception as e:
+            print(f'{path}: {e}')
+            continue
+        print(f'{path} -> {out} in {time.perf_counter() - start:.3f}s')
+
+# A plain attribute that tells its owner when it's assigned a new value.
+class Field:
+    UNSET = object()
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, tp=None):
+        if obj is None:
+            return self
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        old = obj.__dict__.get(self.name, self.UNSET)
+        obj.__dict__[self.name] = value
+        if old is not self.UNSET and old != value:
+            obj.changed(self.name, old, value)
+
+class Model:
+    observers = []
+
+    def changed(self, field, old, new):
+        for ob in self.observers:
+            ob(self, field, old, new)
+
+class ImageEntry:
+    def __init__(self, image, cache=None, digest=None):
+        self.image, self.cache, self.digest = image, cache, digest
+        self.keys = set()
+        self.textures = {}
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+    def __repr__(self):
+        return f'<ImageEntry {self.image.width}x{self.image.height} refs={self.refs} variants={len(self.textures)}>'
+
+    @property
+    def nbytes(self):
+        return 4 * self.image.width * self.image.height * (1 + len(self.textures))
+
+    # Filters are texture state, so a sprite asking for non-default filters
+    # gets its own upload rather than changing them under everyone else.
+    def texture(self, min_filter=None, mag_filter=None):
+        filters = (min_filter, mag_filter)
+        tex = self.textures.get(filters)
+        if tex is not None:
+            return tex
+        before = self.nbytes
+        if filters == (None, None):
+            tex = self.image.get_texture()
+        else:
+            tex = self.image.create_texture(pyglet.image.Texture)
+            owner = tex.owner if isinstance(tex, pyglet.image.TextureRegion) else tex
+            glBindTexture(owner.target, owner.id)
+            if min_filter is not None:
+                glTexParameteri(owner.target, GL_TEXTURE_MIN_FILTER, getattr(pyglet.gl, min_filter))
+            if mag_filter is not None:
+                glTexParameteri(owner.target, GL_TEXTURE_MAG_FILTER, getattr(pyglet.gl, mag_filter))
+            glBindTexture(owner.target, 0)
+        self.textures[filters] = tex
+        if self.cache is not None:
+            self.cache.nbytes += self.nbytes - before
+        return tex
+
+class ImageCache:
+    BUDGET = 1 << 30
+
+    def __init__(self, budget=None):
+        self.budget = self.BUDGET if budget is None else budget
+        self.entries = {}
+        self.digests = {}
+        self.pending = {}
+        self.nbytes = 0
+
+    # Starts decoding path on the decoder pool; the next acquire() of it
+    # picks up the result instead of decoding on the spot. Images the info
+    # cache doesn't know yet get their info derived along the way. Whether it
+    # duplicates an image already here is only checked once it's back.
+    def prefetch(self, path, average=False):
+        try:
+            key = file_key(path)
+        except (OSError, TypeError):
+            return
+        if key in self.entries:
+            return
+        if key not in self.pending:
+            self.pending[key] = decoders().submit(
+                decode_shared, path, average or not INFO.has(path),
+            )
+        return self.pending[key]
+
+    def acquire(self, path):
+        key = file_key(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            future = self.pending.pop(key, None)
+            if future is None:
+                _, digest, decoded = decode_image(
+                    path, not INFO.has(path), self.digests.keys(),
+                )
+            else:
+                _, digest, (w, h, shared, info) = future.result()
+                decoded = (w, h, take_shared(shared), info)
+            entry = self.digests.get(digest)
+            if entry is None:
+                w, h, pixels, info = decoded
+                if info is not None:
+                    Sprite.AVG_CACHE[(key, True)] = info['avg']
+                    encoders().submit(INFO.store, key, digest, info)
+                entry = ImageEntry(
+                    pyglet.image.ImageData(w, h, 'RGBA', pixels, w * 4),
+                    self, digest,
+                )
+                self.digests[digest] = entry
+                self.nbytes += entry.nbytes
+            else:
+                print(f'image {path} shares content with {entry!r}')
+            entry.keys.add(key)
+            self.entries[key] = entry
+        entry.refs += 1
+        entry.last_used = time.monotonic()
+        self.evict()
+        return entry
+
+    def retain(self, entry):
+        if entry.cache is self:
+            entry.refs += 1
+
+    def release(self, entry):
+        if entry.cache is not self:
+            return
+        entry.refs -= 1
+        entry.last_used = time.monotonic()
+        self.evict()
+
+    def evict(self):
+        if self.nbytes <= self.budget:
+            return
+        idle = sorted(
+            (e for e in self.digests.values() if e.refs <= 0),
+            key=lambda e: e.last_used,
+        )
+        for entry in idle:
+            if self.nbytes <= self.budget:
+                break
+            self.drop(entry)
+
+    def drop(self, entry):
+        print(f'evict {entry!r}')
+        for k in entry.keys:
+            self.entries.pop(k, None)
+        self.digests.pop(entry.digest, None)
+        self.nbytes -= entry.nbytes
+        entry.cache = None
+
+IMAGES = ImageCache()
+
+# Derived data about images (see image_info) kept on disk, so it's shared
+# between sessions and charts. Records are named by a digest of the image's
+# contents. The index maps each real path, at an mtime and size, to its digest,
+# so a lookup costs a stat and no reading of the image. Least recently used
+# records go first once the directory is over BUDGET.
+class InfoCache:
+    BUDGET = 64 << 20
+    INDEX = 'index'
+    EXT = '.info'
+    IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.join(
+                os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                'sizechart',
+            )
+        self.root = root
+        self.budget = self.BUDGET
+        self.index = None
+        self.added = {}
+        self.touched = set()
+        self.grew = False
+        self.infos = {}
+        self.lock = threading.Lock()
+
+    def record(self, digest):
+        return os.path.join(self.root, digest + self.EXT)
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.root, self.INDEX), 'rb') as f:
+                return marshal.load(f)
+        except (OSError, ValueError, EOFError, TypeError):
+            return {}
+
+    def lookup(self, path):
+        try:
+            real, mtime, size = file_key(path)
+        except (OSError, TypeError):
+            return None
+        with self.lock:
+            if self.index is None:
+                self.index = self.read_index()
+            hit = self.index.get(real)
+        if hit is None or hit[:2] != (mtime, size):
+            return None
+        return hit[2]
+
+    def has(self, path):
+        return self.lookup(path) is not None
+
+    def get(self, path):
+        digest = self.lookup(path)
+        if digest is None:
+            return None
+        info = self.infos.get(digest)
+        if info is None:
+            try:
+                with open(self.record(digest), 'rb') as f:
+                    info = marshal.load(f)
+            except (OSError, ValueError, EOFError, TypeError):
+                return None
+            self.infos[digest] = info
+            with self.lock:
+                self.touched.add(digest)
+        return info
+
+    # Safe to call from the pool
+    def store(self, key, digest, info):
+        real, mtime, size = key
+        digest = digest.hex()
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = f'{self.record(digest)}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                marshal.dump(info, f)
+            os.replace(tmp, self.record(digest))
+        except OSError as e:
+            print(f'Info not cached: {e}')
+            return
+        with self.lock:
+            if self.index is None:
+                self.index = self.read_index()
+            self.index[real] = self.added[real] = (mtime, size, digest)
+            self.grew = True
+        self.infos[digest] = info
+
+    # Merges what was added here into the index on disk, which another
+    # session may have added to meanwhile. Records read since the last flush
+    # are marked used here too, rather than with a write on every lookup.
+    def flush(self, index=None):
+        with self.lock:
+            touched, self.touched = self.touched, set()
+            if index is None and self.added:
+                index = self.read_index()
+                index.update(self.added)
+            if index is not None:
+                self.added = {}
+                self.index = index
+        for digest in touched:
+            with contextlib.suppress(OSError):
+                os.utime(self.record(digest))
+        if index is None:
+            return
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp = os.path.join(self.root, f'{self.INDEX}.{os.getpid()}.tmp')
+            with open(tmp, 'wb') as f:
+                marshal.dump(index, f)
+            os.replace(tmp, os.path.join(self.root, self.INDEX))
+        except OSError as e:
+            print(f'Info index not written: {e}')
+
+    # Forgets paths that have changed or gone, then deletes the least
+    # recently used records until the rest fit in the budget
+    def prune(self):
+        self.flush()
+        index = {}
+        seen = self.read_index()
+        for real, (mtime, size, digest) in seen.items():
+            try:
+                st = os.stat(real)
+            except OSError:
+                continue
+            if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                index[real] = (mtime, size, digest)
+        records = []
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            names = []
+        for name in names:
+            if name.endswith(self.EXT):
+                try:
+                    st = os.stat(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                records.append((st.st_mtime, st.st_size, name[:-len(self.EXT)]))
+        records.sort(reverse=True)
+        total, keep = 0, set()
+        for _, size, digest in records:
+            if total + size <= self.budget:
+                total += size
+                keep.add(digest)
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(self.record(digest))
+                self.infos.pop(digest, None)
+        index = {k: v for k, v in index.items() if v[2] in keep}
+        # Keep what another session added while this was looking
+        for real, ent in self.read_index().items():
+            if real not in seen and os.path.exists(self.record(ent[2])):
+                index[real] = ent
+        self.flush(index)
+        print(f'Info cache: {len(keep)} records, {si(total)}B, {len(index)} paths')
+
+    def size(self):
+        total = 0
+        try:
+            with os.scandir(self.root) as it:
+                for ent in it:
+                    if ent.name.endswith(self.EXT):
+                        with contextlib.suppress(OSError):
+                            total += ent.stat().st_size
+        except OSError:
+            pass
+        return total
+
+    # At exit: only a session that added records can have gone over budget,
+    # so anything else just writes out what it added and used
+    def close(self):
+        if self.grew and self.size() > self.budget:
+            self.prune()
+        else:
+            self.flush()
+
+    # Derives info for every image under dirs that isn't cached yet
+    def warm(self, dirs):
+        paths = [
+            os.path.join(d, f)
+            for top in dirs
+            for d, _, fs in os.walk(top)
+            for f in fs
+            if f.lower().endswith(self.IMAGE_EXTS)
+        ]
+        todo = [p for p in paths if not self.has(p)]
+        print(f'{len(paths)} images, {len(todo)} to read')
+        futs = {decoders().submit(derive_image, p): p for p in todo}
+        for fut in concurrent.futures.as_completed(futs):
+            try:
+                key, digest, info = fut.result()
+            except Exception as e:
+                print(f'{futs[fut]}: {e}')
+                continue
+            self.store(key, digest, info)
+        self.prune()
+
+INFO = InfoCache()
+
+# Maps world coordinates to the screen, as Canvas.map_point does, for
+# anything drawn in a batch under it.
+class CameraGroup(pyglet.graphics.Group):
+    def __init__(self, canvas, parent=None):
+        super().__init__(parent)
+        self.canvas = canvas
+
+    def set_state(self):
+        glPushMatrix()
+        glScalef(self.canvas.scale, self.canvas.scale, 1.0)
+        glTranslatef(-self.canvas.origin.x, -self.canvas.origin.y, 0.0)
+
+    def unset_state(self):
+        glPopMatrix()
+
+class LineWidthGroup(pyglet.graphics.OrderedGroup):
+    def __init__(self, width, parent=None):
+        super().__init__(width, parent)
+        self.width = width
+
+    def set_state(self):
+        glLineWidth(self.width)
+
+    def unset_state(self):
+        glLineWidth(1)
+
+class Shape:
+    def __init__(self, vlist):
+        self.vlist = vlist
+        self.state = None
+
+    def set(self, verts, color):
+        state = (verts, color)
+        if state == self.state:
+            return
+        self.state = state
+        self.vlist.vertices[:] = verts
+        self.vlist.colors[:] = color * (len(verts) // 2)
+
+    def hide(self):
+        if self.state is not None:
+            self.state = None
+            self.vlist.vertices[:] = [0] * len(self.vlist.vertices)
+
+    def delete(self):
+        self.vlist.delete()
+
+# Lines and rects in world coordinates, kept in one batch between frames.
+# Each frame hands out the same shapes in the order they are asked for, so
+# only the ones that actually changed get their vertices rewritten.
+class ShapeLayer:
+    SPARE = 16
+
+    def __init__(self, batch, parent):
+        self.batch = batch
+        self.parent = parent
+        self.fill_group = pyglet.graphics.OrderedGroup(0, parent)
+        self.line_groups = {}
+        self.pools = {}
+        self.used = {}
+
+    def group(self, mode, width):
+        if mode != GL_LINES:
+            return self.fill_group
+        group = self.line_groups.get(width)
+        if group is None:
+            group = self.line_groups[width] = LineWidthGroup(width, self.parent)
+        return group
+
+    def begin(self):
+        self.used = {}
+
+    def shape(self, mode, count, width=1):
+        key = (mode, count, width)
+        pool = self.pools.setdefault(key, [])
+        n = self.used.get(key, 0)
+        self.used[key] = n + 1
+        if n == len(pool):
+            pool.append(Shape(self.batch.add(
+                count, mode, self.group(mode, width),
+                'v2f/dynamic', 'c3B/dynamic',
+            )))
+        return pool[n]
+
+    def end(self):
+        for k, pool in self.pools.items():
+            n = self.used.get(k, 0)
+            for shape in pool[n:]:
+                shape.hide()
+            keep = 2 * n + self.SPARE
+            if len(pool) > keep:
+                for shape in pool[keep:]:
+                    shape.delete()
+                del pool[keep:]
+
+    def line(self, a, b, color, width=1):
+        self.shape(GL_LINES, 2, width).set((a.x, a.y, b.x, b.y), color)
+
+    def rect(self, r, color, stroke=True, fill=False):
+        x0, y0, x1, y1 = r.x, r.y, r.x + r.w, r.y + r.h
+        if fill:
+            self.shape(GL_QUADS, 4).set((x0, y0, x1, y0, x1, y1, x0, y1), color)
+        if stroke:
+            self.shape(GL_LINES, 8).set((
+                x0, y0, x1, y0,
+                x1, y0, x1, y1,
+                x1, y1, x0, y1,
+                x0, y1, x0, y0,
+            ), color)
+
+# Labels in screen coordinates, cached by everything that affects their
+# layout. A label asked for again next frame just moves; ones not asked for
+# are parked off screen until the cache is over CAPACITY and they age out.
+class TextLayer:
+    CAPACITY = 512
+    HIDDEN = -10000
+
+    def __init__(self, batch, group):
+        self.batch = batch
+        self.group = group
+        self.labels = collections.OrderedDict()
+        self.used = {}
+        self.count = 0
+
+    def begin(self):
+        self.used = {}
+
+    def label(self, text, p, color, size, anchor_x, anchor_y):
+        key = (text, size, color, anchor_x, anchor_y)
+        pool = self.labels.get(key)
+        if pool is None:
+            pool = self.labels[key] = []
+        else:
+            self.labels.move_to_end(key)
+        n = self.used.get(key, 0)
+        self.used[key] = n + 1
+        if n == len(pool):
+            pool.append(pyglet.text.Label(
+                text,
+                x = p.x, y = p.y,
+                color = color + (255,),
+                font_size = size,
+                anchor_x = anchor_x, anchor_y = anchor_y,
+                batch = self.batch, group = self.group,
+            ))
+            self.count += 1
+        elif pool[n].position != (p.x, p.y):
+            pool[n].update(p.x, p.y)
+
+    def end(self):
+        for k, pool in self.labels.items():
+            for label in pool[self.used.get(k, 0):]:
+                if label.y != self.HIDDEN:
+                    label.update(label.x, self.HIDDEN)
+        while self.count > self.CAPACITY:
+            k, pool = next(iter(self.labels.items()))
+            if k in self.used:
+                break
+            del self.labels[k]
+            for label in pool:
+                label.delete()
+            self.count -= len(pool)
+
+class Layer:
+    def __init__(self, canvas):
+        self.batch = pyglet.graphics.Batch()
+        self.shapes = ShapeLayer(
+            self.batch,
+            CameraGroup(canvas, pyglet.graphics.OrderedGroup(0)),
+        )
+        self.texts = TextLayer(self.batch, pyglet.graphics.OrderedGroup(1))
+
+    def begin(self):
+        self.shapes.begin()
+        self.texts.begin()
+
+    def end(self):
+        self.shapes.end()
+        self.texts.end()
+
+# Grid lines for one step size, in world coordinates, covering a padded
+# extent around the view. Pans inside the extent only move the camera; past
+# it, lines are added and dropped at the edges. A new step size (zooming
+# across a decade), unit or colour starts over.
+class Grid:
+    PAD = 1
+
+    def __init__(self, layer, origin_width=1):
+        self.layer = layer
+        self.origin_width = origin_width
+        self.key = None
+        self.extent = None
+        self.lines = {}
+
+    def clear(self):
+        for vlist in self.lines.values():
+            vlist.delete()
+        self.lines = {}
+        self.extent = None
+
+    def update(self, vb, per, color):
+        sx, sy = grid_step(vb.w / per), grid_step(vb.h / per)
+        key = (sx, sy, per, color)
+        if key != self.key:
+            self.clear()
+            self.key = key
+        x0, y0, x1, y1 = vb.x, vb.y, vb.x + vb.w, vb.y + vb.h
+        if self.extent is not None:
+            ex0, ey0, ex1, ey1 = self.extent
+            if ex0 <= x0 and ey0 <= y0 and x1 <= ex1 and y1 <= ey1:
+                return
+        pw, ph = self.PAD * vb.w, self.PAD * vb.h
+        ex0, ey0, ex1, ey1 = self.extent = (x0 - pw, y0 - ph, x1 + pw, y1 + ph)
+
+        wanted = {}
+        for k in range(math.floor(ey0 / per / sy), math.floor(ey1 / per / sy) + 1):
+            vy = k * sy * per
+            wanted[('y', k)] = (ex0, vy, ex1, vy)
+        for k in range(math.floor(ex0 / per / sx), math.floor(ex1 / per / sx) + 1):
+            vx = k * sx * per
+            wanted[('x', k)] = (vx, ey0, vx, ey1)
+        for lk in set(self.lines) - set(wanted):
+            self.lines.pop(lk).delete()
+        for lk, verts in wanted.items():
+            vlist = self.lines.get(lk)
+            if vlist is None:
+                width = self.origin_width if lk[1] == 0 else 1
+                self.lines[lk] = self.layer.batch.add(
+                    2, GL_LINES, self.layer.shapes.group(GL_LINES, width),
+                    ('v2f/dynamic', verts), ('c3B/static', color * 2),
+                )
+            else:
+                vlist.vertices[:] = verts
+
+    def ys(self, vb):
+        sy, per = self.key[1], self.key[2]
+        lo, hi = vb.y / per, (vb.y + vb.h) / per
+        return (k * sy for k in range(int(lo / sy), math.floor(hi / sy) + 1))
+
+    def xs(self, vb):
+        sx, per = self.key[0], self.key[2]
+        lo, hi = vb.x / per, (vb.x + vb.w) / per
+        return (k * sx for k in range(int(lo / sx), math.floor(hi / sx) + 1))
+
+# Uniform grid over world-space boxes (x0, y0, x1, y1), each with a rank that
+# orders the hits (highest first). Boxes that cover too many cells are kept
+# aside and checked on every query.
+class SpatialIndex:
+    CELL = 512.0
+    MAX_CELLS = 64
+
+    def __init__(self, cell=CELL):
+        self.cell = cell
+        self.cells = {}
+        self.big = set()
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def span(self, box):
+        x0, y0, x1, y1 = box
+        c = self.cell
+        return (
+            range(math.floor(x0 / c), math.floor(x1 / c) + 1),
+            range(math.floor(y0 / c), math.floor(y1 / c) + 1),
+        )
+
+    def update(self, obj, box, rank=0):
+        old = self.entries.get(obj)
+        if old is not None:
+            if old[0] == box and old[1] == rank:
+                return
+            self.remove(obj)
+        xs, ys = self.span(box)
+        if len(xs) * len(ys) > self.MAX_CELLS:
+            cells = None
+            self.big.add(obj)
+        else:
+            cells = [(i, j) for i in xs for j in ys]
+            for cell in cells:
+                self.cells.setdefault(cell, set()).add(obj)
+        self.entries[obj] = (box, rank, cells)
+
+    def remove(self, obj):
+        ent = self.entries.pop(obj, None)
+        if ent is None:
+            return
+        if ent[2] is None:
+            self.big.discard(obj)
+            return
+        for cell in ent[2]:
+            objs = self.cells[cell]
+            objs.discard(obj)
+            if not objs:
+                del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.big.clear()
+        self.entries.clear()
+
+    def ranked(self, objs):
+        return sorted(objs, key=lambda o: self.entries[o][1], reverse=True)
+
+    def query_point(self, p):
+        x, y = p
+        c = self.cell
+        found = set(self.big)
+        found.update(self.cells.get((math.floor(x / c), math.floor(y / c)), ()))
+        hits = []
+        for obj in found:
+            x0, y0, x1, y1 = self.entries[obj][0]
+            if x0 <= x < x1 and y0 <= y < y1:
+                hits.append(obj)
+        return self.ranked(hits)
+
+    def query_rect(self, box):
+        qx0, qy0, qx1, qy1 = box
+        xs, ys = self.span(box)
+        found = set(self.big)
+        if len(xs) * len(ys) > len(self.cells):
+            for (i, j), objs in self.cells.items():
+                if i in xs and j in ys:
+                    found.update(objs)
+        else:
+            for i in xs:
+                for j in ys:
+                    found.update(self.cells.get((i, j), ()))
+        hits = []
+        for obj in found:
+            x0, y0, x1, y1 = self.entries[obj][0]
+            if x0 <= qx1 and x1 >= qx0 and y0 <= qy1 and y1 >= qy0:
+                hits.append(obj)
+        return self.ranked(hits)
+
+# Smallest value over a set of objects whose values keep changing; stale heap
+# entries are skipped when they surface.
+class LazyMin:
+    def __init__(self):
+        self.values = {}
+        self.heap = []
+        self.serial = itertools.count()
+
+    def set(self, obj, value):
+        if self.values.get(obj) == value:
+            return
+        self.values[obj] = value
+        heapq.heappush(self.heap, (value, next(self.serial), obj))
+        if len(self.heap) > 2 * len(self.values) + 64:
+            self.heap = [(v, next(self.serial), o) for o, v in self.values.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, obj):
+        self.values.pop(obj, None)
+
+    def clear(self):
+        self.values.clear()
+        self.heap.clear()
+
+    def min(self, default=0):
+        heap = self.heap
+        while heap and self.values.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else default
+
+# Prefix sums over values that change in place, each step costing O(log n)
+class Fenwick:
+    def __init__(self, values=()):
+        tree = [0] + list(values)
+        n = len(tree) - 1
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    # One more value on the end, without rebuilding
+    def append(self, value):
+        i = len(self.tree)
+        self.tree.append(value + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+
+    def prefix(self, i):
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    # (i, rest) for the last i with prefix(i) <= k; values must be >= 0
+    def search(self, k):
+        tree = self.tree
+        i, step = 0, 1 << (len(tree) - 1).bit_length()
+        while step:
+            j = i + step
+            if j < len(tree) and tree[j] <= k:
+                i = j
+                k -= tree[j]
+            step >>= 1
+        return i, k
+
+# A stretch of neighbouring sprites in a Layout. Offsets and the extent are
+# relative to where the run starts, so edits in other runs never touch them.
+class Run:
+    def __init__(self, items, adv):
+        self.items = items
+        self.adv = adv
+        self.pos = 0
+        self.slots = None
+        self.offs = None
+        self.box = None
+        self.sum = None
+
+    # Something in the run changed size or place
+    def touch(self):
+        self.offs = self.box = self.sum = None
+
+    # Sprites were added, taken out or reordered
+    def shuffled(self):
+        self.slots = None
+        self.touch()
+
+    def local(self, spr):
+        if self.slots is None:
+            self.slots = {s: k for k, s in enumerate(self.items)}
+        return self.slots[spr]
+
+    def offsets(self):
+        if self.offs is None:
+            self.offs = [0.0] + list(itertools.accumulate(self.adv[:-1]))
+        return self.offs
+
+    # Sprites' absolute bounds, given where the run starts
+    def bounds(self, x):
+        for spr, off in zip(self.items, self.offsets()):
+            y = spr.y * spr.scale
+            if spr.size is None:
+                yield spr, (x + off, y, x + off, y)
+            else:
+                yield spr, (x + off, y, x + off + spr.width, y + spr.height)
+
+    def extent(self):
+        if self.box is None:
+            boxes = [b for _, b in self.bounds(0.0)]
+            self.box = (
+                min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes),
+            )
+        return self.box
+
+    # As RunTree keeps it: (advance, x0, y0, x1, y1), relative
+    def summary(self):
+        if self.sum is None:
+            if not self.items:
+                self.sum = RunTree.EMPTY
+            else:
+                self.sum = (sum(self.adv), *self.extent())
+        return self.sum
+
+# Segment tree over a Layout's runs. Each node holds, for its runs laid end
+# to end, their total advance and the box they cover relative to where the
+# first of them starts. Moving one run's edge only touches its path to the
+# root, and a box query only walks down into nodes that meet the box.
+class RunTree:
+    EMPTY = (0.0, math.inf, math.inf, -math.inf, -math.inf)
+
+    def __init__(self, runs=()):
+        runs = list(runs)
+        size = 1
+        while size < len(runs):
+            size *= 2
+        self.size = size
+        self.nodes = [self.EMPTY] * (2 * size)
+        for pos, run in enumerate(runs):
+            self.nodes[size + pos] = run.summary()
+        for i in range(size - 1, 0, -1):
+            self.nodes[i] = self.join(self.nodes[2 * i], self.nodes[2 * i + 1])
+
+    @staticmethod
+    def join(a, b):
+        t = a[0]
+        return (
+            t + b[0],
+            min(a[1], t + b[1]), min(a[2], b[2]),
+            max(a[3], t + b[3]), max(a[4], b[4]),
+        )
+
+    def set(self, pos, summary):
+        i = self.size + pos
+        self.nodes[i] = summary
+        i //= 2
+        while i:
+            self.nodes[i] = self.join(self.nodes[2 * i], self.nodes[2 * i + 1])
+            i //= 2
+
+    # Total advance of the runs before pos
+    def prefix(self, pos):
+        total = 0.0
+        i = self.size + pos
+        while i > 1:
+            if i & 1:
+                total += self.nodes[i - 1][0]
+            i //= 2
+        return total
+
+    # (pos, x) for each run whose box meets box, in order, x being where it
+    # starts
+    def query(self, box):
+        qx0, qy0, qx1, qy1 = box
+        found = []
+        stack = [(1, 0.0)]
+        while stack:
+            i, x = stack.pop()
+            _, x0, y0, x1, y1 = self.nodes[i]
+            if x + x0 > qx1 or x + x1 < qx0 or y0 > qy1 or y1 < qy0:
+                continue
+            if i >= self.size:
+                found.append((i - self.size, x))
+            else:
+                stack.append((2 * i + 1, x + self.nodes[2 * i][0]))
+                stack.append((2 * i, x))
+        return found
+
+# The sprites of a chart in order, laid out left to right: each starts where
+# the one before it started plus its advance (width * overlap). Sprites are
+# kept in runs of about RUN; a RunTree places each run and finds the ones a
+# query meets, and a Fenwick tree over their lengths maps indices to runs, so
+# an edit only costs its own run plus O(log n).
+class Layout:
+    RUN = 64
+
+    def __init__(self):
+        self.runs = []
+        self.where = {}
+        self.count = 0
+        self.tree = RunTree()
+        self.dirty = set()
+        self.counts = Fenwick()
+        self.lows = LazyMin()
+        self.tops = LazyMin()
+        # Bumped whenever sprites are added, removed or reordered
+        self.revision = 0
+        # Called as on_change(spr, old_index, new_index), None meaning out
+        self.on_change = None
+        Model.observers.append(self.changed)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for run in self.runs:
+            yield from run.items
+
+    def __reversed__(self):
+        for run in reversed(self.runs):
+            yield from reversed(run.items)
+
+    def __contains__(self, spr):
+        return spr in self.where
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        run, k = self.locate(i)
+        return run.items[k]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def index(self, spr):
+        try:
+            run = self.where[spr]
+        except KeyError:
+            raise ValueError(spr) from None
+        return self.counts.prefix(run.pos) + run.local(spr)
+
+    @staticmethod
+    def advance_of(spr):
+        if spr.size is None:
+            return 0.0
+        return spr.width * spr.olap
+
+    def locate(self, i):
+        pos, k = self.counts.search(i)
+        return self.runs[pos], k
+
+    # Runs were added, split or dropped; only O(runs) to renumber
+    def reindex(self):
+        for pos, run in enumerate(self.runs):
+            run.pos = pos
+        self.dirty.clear()
+        self.tree = RunTree(self.runs)
+        self.counts = Fenwick(len(run.items) for run in self.runs)
+
+    # Brings the tree up to date with the runs changed since
+    def settle(self):
+        for run in self.dirty:
+            self.tree.set(run.pos, run.summary())
+        self.dirty.clear()
+
+    def put(self, run, k, spr):
+        adv = self.advance_of(spr)
+        run.items.insert(k, spr)
+        run.adv.insert(k, adv)
+        run.shuffled()
+        self.where[spr] = run
+        self.count += 1
+        if len(run.items) > 2 * self.RUN:
+            half = len(run.items) // 2
+            new = Run(run.items[half:], run.adv[half:])
+            del run.items[half:], run.adv[half:]
+            run.shuffled()
+            for moved in new.items:
+                self.where[moved] = new
+            self.runs.insert(run.pos + 1, new)
+            self.reindex()
+        else:
+            self.dirty.add(run)
+            self.counts.add(run.pos, 1)
+
+    def put_last(self, spr):
+        if not self.runs or len(self.runs[-1].items) >= self.RUN:
+            run = Run([], [])
+            run.pos = len(self.runs)
+            self.runs.append(run)
+            self.counts.append(0)
+            # The tree only has to be rebuilt when it doubles
+            if run.pos < self.tree.size:
+                self.tree.set(run.pos, run.summary())
+            else:
+                self.tree = RunTree(self.runs)
+                self.dirty.clear()
+        run = self.runs[-1]
+        self.put(run, len(run.items), spr)
+
+    def take(self, spr):
+        run = self.where.pop(spr)
+        k = run.local(spr)
+        del run.items[k], run.adv[k]
+        run.shuffled()
+        self.count -= 1
+        if not run.items:
+            del self.runs[run.pos]
+            self.reindex()
+        else:
+            self.dirty.add(run)
+            self.counts.add(run.pos, -1)
+
+    def insert(self, i, spr):
+        if i < 0:
+            i = max(0, self.count + i)
+        if i >= self.count:
+            return self.append(spr)
+        self.revision += 1
+        self.put(*self.locate(i), spr)
+        spr.layout = self
+        self.set_extent(spr)
+        if self.on_change is not None:
+            self.on_change(spr, None, i)
+
+    def append(self, spr):
+        i = self.count
+        self.revision += 1
+        self.put_last(spr)
+        spr.layout = self
+        self.set_extent(spr)
+        if self.on_change is not None:
+            self.on_change(spr, None, i)
+
+    def extend(self, sprs):
+        for spr in sprs:
+            self.append(spr)
+
+    def pop(self, i=-1):
+        spr = self[i]
+        if i < 0:
+            i += self.count
+        self.revision += 1
+        self.take(spr)
+        self.lows.discard(spr)
+        self.tops.discard(spr)
+        spr.layout = None
+        if self.on_change is not None:
+            self.on_change(spr, i, None)
+        return spr
+
+    def remove(self, spr):
+        self.pop(self.index(spr))
+
+    def clear(self):
+        self.revision += 1
+        for spr in self:
+            spr.layout = None
+        self.runs = []
+        self.where.clear()
+        self.count = 0
+        self.lows.clear()
+        self.tops.clear()
+        self.reindex()
+
+    def __delitem__(self, i):
+        if isinstance(i, slice) and i == slice(None):
+            self.clear()
+        elif isinstance(i, slice):
+            for j in sorted(range(*i.indices(self.count)), reverse=True):
+                self.pop(j)
+        else:
+            self.pop(i)
+
+    def move(self, spr, place):
+        i = self.index(spr)
+        place = max(0, min(place, self.count - 1))
+        if place == i:
+            return
+        self.revision += 1
+        self.take(spr)
+        if place < self.count:
+            self.put(*self.locate(place), spr)
+        else:
+            self.put_last(spr)
+        if self.on_change is not None:
+            self.on_change(spr, i, place)
+
+    def x_of(self, spr):
+        if self.dirty:
+            self.settle()
+        run = self.where[spr]
+        return self.tree.prefix(run.pos) + run.offsets()[run.local(spr)]
+
+    def changed(self, obj, field, old, new):
+        run = self.where.get(obj)
+        if run is None:
+            return
+        if field in ('scale', 'olap', 'size'):
+            run.adv[run.local(obj)] = self.advance_of(obj)
+            run.touch()
+            self.dirty.add(run)
+        if field in ('scale', 'y', 'size'):
+            self.set_extent(obj)
+            run.touch()
+            self.dirty.add(run)
+
+    def set_extent(self, spr):
+        low = spr.y * spr.scale
+        self.lows.set(spr, low)
+        if spr.size is not None:
+            self.tops.set(spr, -(low + spr.height))
+
+    @property
+    def min_y(self):
+        return self.lows.min()
+
+    @property
+    def max_y(self):
+        return -self.tops.min()
+
+    # (sprite, bounds) for every sprite in a run whose extent meets box
+    def candidates(self, box):
+        self.settle()
+        for pos, x in self.tree.query(box):
+            yield from self.runs[pos].bounds(x)
+
+    # Hits come topmost (latest in the layout) first
+    def query_point(self, p):
+        x, y = p
+        hits = []
+        for spr, (x0, y0, x1, y1) in self.candidates((x, y, x, y)):
+            if x0 <= x < x1 and y0 <= y < y1:
+                hits.append(spr)
+        return hits[::-1]
+
+    def query_rect(self, box):
+        qx0, qy0, qx1, qy1 = box
+        hits = []
+        for spr, (x0, y0, x1, y1) in self.candidates(box):
+            if x0 <= qx1 and x1 >= qx0 and y0 <= qy1 and y1 >= qy0:
+                hits.append(spr)
+        return hits[::-1]
+
+# Part of a Layout frozen for a render job: copies of the sprites that meet
+# some boxes, kept where they were, so edits made while the job runs don't
+# show up in only the tiles drawn after them. Stands in for the Layout as far
+# as App.render needs.
+class Pinned:
+    def __init__(self, layout, boxes):
+        self.count = len(layout)
+        self.min_y, self.max_y = layout.min_y, layout.max_y
+        self.copies = {}
+        self.xs = {}
+        self.spatial = SpatialIndex()
+        for box in boxes:
+            for spr in layout.query_rect(box):
+                if spr in self.copies or spr.size is None:
+                    continue
+                copy = self.copies[spr] = spr.copy()
+                copy.layout = self
+                self.xs[copy] = spr.x
+                self.spatial.update(copy, spr.bounds, layout.index(spr))
+        self.batch = pyglet.graphics.Batch()
+        self.shown = set()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, spr):
+        return spr in self.xs
+
+    def x_of(self, spr):
+        return self.xs[spr]
+
+    def query_point(self, p):
+        return self.spatial.query_point(p)
+
+    def query_rect(self, box):
+        return self.spatial.query_rect(box)
+
+    def delete(self):
+        for copy in self.copies.values():
+            copy.layout = None
+            copy.delete()
+        self.copies.clear()
+
 class Canvas:
+    origin = Field()
+    scale = Field()
+
     def __init__(self, disp, origin = Vec2(), scale=0.01):
+        self.on_change = None
         self.disp, self.origin, self.scale = disp, origin, scale
         self.font = pygame.font.Font(None, 24)
         self.target_size = None
+        self.camera = CameraGroup(self)
+        self.layers = {}
+        self.current = None
+
+    def changed(self, field, old, new):
+        if self.on_change is not None:
+            self.on_change()
 
     @property
     def view_size(self):
@@ -156,6 +2065,12 @@ class Canvas:
         x, y = self.origin
         return Rect(x, y, w / self.scale, h / self.scale)
 
+    @property
+    def view_bounds(self):
+        w, h = self.view_size
+        x, y = self.origin
+        return (x, y, x + w / self.scale, y + h / self.scale)
+
     def map_scaled(self, p):
         return p * self.scale
 
@@ -186,66 +2101,244 @@ class Canvas:
     def clear(self):
         self.disp.clear()
 
-    def draw_sprite(self, spr):
-        old_scale = spr.scale
-        old_pos = spr.position
+    def draw_batch(self, batch):
+        batch.draw()
 
-        spr.x = (spr.x - self.origin.x) * self.scale
-        spr.y = (spr.y - self.origin.y) * self.scale
-        spr.scale *= self.scale
-        spr.draw()
-
-        spr.scale = old_scale
-        spr.position = old_pos
+    @contextlib.contextmanager
+    def layer(self, name):
+        layer = self.layers.get(name)
+        if layer is None:
+            layer = self.layers[name] = Layer(self)
+        outer, self.current = self.current, layer
+        layer.begin()
+        try:
+            yield layer
+        finally:
+            self.current = outer
+            layer.end()
+            self.draw_batch(layer.batch)
 
     def draw_rect(self, r, color=(255, 255, 255), stroke=True, fill=False):
-        p = self.map_point(Vec2(r.x, r.y))
-        s = self.map_scaled(Vec2(r.w, r.h))
-        if fill:
-            pyglet.shapes.Rectangle(
-                    x = p.x, y = p.y,
-                    width = s.x, height = s.y,
-                    color = color,
-            ).draw()
-        if stroke:
-            pts = [p, p + Vec2(s.x, 0), p+s, p + Vec2(0, s.y), p]
-            line = pyglet.shapes.Line(0, 0, 0, 0, color=color)
-            for a, b in zip(pts, pts[1:]):
-                line.x, line.y = a
-                line.x2, line.y2 = b
-                line.draw()
+        if self.current is None:
+            with self.layer(None):
+                return self.draw_rect(r, color, stroke, fill)
+        self.current.shapes.rect(r, color, stroke, fill)
 
     def draw_line(self, a, b, color=(255, 255, 255), width=1):
-        a, b = self.map_point(a), self.map_point(b)
-        pyglet.shapes.Line(
-            a.x, a.y, b.x, b.y,
-            width = width,
-            color = color,
-        ).draw()
-
-    def draw_text(self, s, p, color=(255, 255, 255), anchor_x='left', anchor_y='baseline'):
-        #print(f'text {s} {p} {color}')
-        p = self.map_point(p)
-        pyglet.text.Label(
-            s,
-            x = p.x, y = p.y,
-            color = color + (255,),
-            font_size = 24,
-            anchor_x = anchor_x, anchor_y = anchor_y,
-        ).draw()
-
-class Sprite:
-    def __init__(self, img, path, scale=1.0, olap = 0.75, y = 0.0, refy = None, name = 'unnamed', asset = None, avg_color = None, mag_filter=None, min_filter=None):
-        self.img, self.path, self.scale, self.olap, self.y = img, path, scale, olap, y
-        if avg_color is None:
-            avg_color = self.average_color(self.img)
+        if self.current is None:
+            with self.layer(None):
+                return self.draw_line(a, b, color, width)
+        self.current.shapes.line(a, b, color, width)
+
+    def draw_text(self, s, p, color=(255, 255, 255), anchor_x='left', anchor_y='baseline', size=24):
+        if self.current is None:
+            with self.layer(None):
+                return self.draw_text(s, p, color, anchor_x, anchor_y, size)
+        self.current.texts.label(s, self.map_point(p), color, size, anchor_x, anchor_y)
+
+# One per .asset file, shared by every Sprite that refers to it. attrs is what
+# the file holds as far as we know (as last read or written) and stamp its
+# mtime and size then, so an unchanged asset isn't read or written again.
+# Writes happen on the pool, so both are only touched under the registry lock.
+class Asset:
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+        self.attrs = None
+        self.stamp = None
+
+    def read(self):
+        stamp = file_stamp(self.path)
+        with self.lock:
+            if self.attrs is not None and stamp is not None and stamp == self.stamp:
+                return self.attrs
+        root = ET.ElementTree(file=self.path).getroot()
+        with self.lock:
+            self.attrs, self.stamp = dict(root.attrib), stamp
+            return self.attrs
+
+    # As Sprite() takes them, path included
+    def params(self):
+        attrs = self.read()
+        ry = attrs.get(SC.referenceY)
+        ac = attrs.get(SC.averageColor)
+        return dict(
+            path=attrs.get(SC.path),
+            scale=float(attrs.get(SC.scale, 1.0)),
+            y=float(attrs.get(SC.offsetY, 0.0)),
+            refy=None if ry is None else float(ry),
+            name=attrs.get(SC.name, 'unnamed'),
+            avg_color=None if ac is None else tuple(int(i.strip()) for i in ac.split(',')),
+            min_filter=attrs.get(SC.minFilter),
+            mag_filter=attrs.get(SC.magFilter),
+        )
+
+    def dirty(self, attrs):
+        stamp = file_stamp(self.path)
+        with self.lock:
+            return attrs != self.attrs or stamp != self.stamp
+
+    def write(self, attrs):
+        write_text(self.path, ET.tostring(ET.Element(SC.asset, attrs), 'unicode'))
+        stamp = file_stamp(self.path)
+        with self.lock:
+            self.attrs, self.stamp = dict(attrs), stamp
+
+class AssetRegistry:
+    def __init__(self):
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, path):
+        key = os.path.abspath(path)
+        with self.lock:
+            asset = self.assets.get(key)
+            if asset is None:
+                asset = self.assets[key] = Asset(path, self.lock)
+        return asset
+
+    # Writes {path: attrs} out on the pool, skipping assets that already say
+    # that; returns the futures. Key writes by os.path.abspath, as assets are,
+    # so one file can't be written twice at once.
+    def write_all(self, writes):
+        pool = encoders()
+        return [
+            pool.submit(self[path].write, attrs)
+            for path, attrs in writes.items()
+            if self[path].dirty(attrs)
+        ]
+
+ASSETS = AssetRegistry()
+
+class Sprite(Model):
+    path = Field()
+    scale = Field()
+    olap = Field()
+    y = Field()
+    size = Field()
+    refy = Field()
+    name = Field()
+    asset = Field()
+    avg_col = Field()
+    _mag_filter = Field()
+    _min_filter = Field()
+
+    def __init__(self, img, path, scale=1.0, olap = 0.75, y = 0.0, refy = None, name = 'unnamed', asset = None, avg_color = None, mag_filter=None, min_filter=None, size=None):
+        self.path, self.scale, self.olap, self.y = path, scale, olap, y
         self.avg_col = avg_color
-        self.sprite = pyglet.sprite.Sprite(img=self.img)
+        self._mag_filter, self._min_filter = mag_filter, min_filter
         self.refy = refy
         self.name = name
         self.asset = asset
-        self.lastx = None
-        self._mag_filter, self._min_filter = mag_filter, min_filter
+        self.layout = None
+        self.entry = None
+        self.size = None if size is None else Vec2(*size)
+        self.pending = None
+        self.thumb = None
+        self.last_seen = time.monotonic()
+        self.geom = None
+        self.sprite = pyglet.sprite.Sprite(img=self.placeholder(), subpixel=True)
+        if img is not None:
+            self.set_entry(img)
+        else:
+            self.reset_filters()
+
+    # Every Sprite holding a decoded image, for App.evict_far()
+    LOADED = set()
+
+    PLACEHOLDER = None
+    PLACEHOLDER_COLOR = (128, 128, 128)
+    @classmethod
+    def placeholder(cls):
+        if cls.PLACEHOLDER is None:
+            cls.PLACEHOLDER = pyglet.image.create(
+                8, 8,
+                pyglet.image.CheckerImagePattern(
+                    (64, 64, 64, 255),
+                    (96, 96, 96, 255),
+                ),
+            ).get_texture()
+            glBindTexture(cls.PLACEHOLDER.target, cls.PLACEHOLDER.id)
+            glTexParameteri(cls.PLACEHOLDER.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glBindTexture(cls.PLACEHOLDER.target, 0)
+        return cls.PLACEHOLDER
+
+    @staticmethod
+    def missing(size):
+        return pyglet.image.create(
+            *size,
+            pyglet.image.CheckerImagePattern(
+                (255, 0, 255, 255),
+                (0, 0, 0, 255),
+            ),
+        )
+
+    @property
+    def img(self):
+        if self.entry is None:
+            return None
+        return self.entry.image
+
+    @property
+    def loaded(self):
+        return self.entry is not None
+
+    def set_entry(self, entry):
+        if not isinstance(entry, ImageEntry):
+            entry = ImageEntry(entry)
+        if self.entry is not None:
+            IMAGES.release(self.entry)
+        self.entry = entry
+        self.LOADED.add(self)
+        size = (entry.image.width, entry.image.height)
+        # Reloading the same image isn't an edit
+        if self.size is None or tuple(self.size) != size:
+            self.size = Vec2(*size)
+        if self.avg_col is None:
+            self.avg_col = self.average_color(entry.image, self.path)
+        self.thumb = None
+        self.reset_filters()
+
+    # Starts decoding in the background; poll_load() finishes it once done.
+    def request_load(self, done=None):
+        if self.loaded or self.pending is not None:
+            return
+        self.pending = IMAGES.prefetch(self.path, self.avg_col is None)
+        if self.pending is None:
+            self.load()
+            return
+        # Something better than a checkerboard while it decodes
+        info = INFO.get(self.path)
+        if info is not None:
+            tw, th, pixels = info['thumb']
+            self.thumb = pyglet.image.ImageData(tw, th, 'RGBA', pixels, tw * 4).get_texture()
+            self.reset_filters()
+        if done is not None:
+            self.pending.add_done_callback(lambda f: done())
+
+    def poll_load(self):
+        if self.pending is not None and self.pending.done():
+            self.load()
+
+    def load(self):
+        self.pending = None
+        if self.loaded:
+            return
+        try:
+            entry = IMAGES.acquire(self.path)
+        except FileNotFoundError:
+            entry = self.missing(self.size)
+        except Exception:
+            traceback.print_exc()
+            entry = self.missing(self.size)
+        self.set_entry(entry)
+
+    def unload(self):
+        if not self.loaded:
+            return
+        IMAGES.release(self.entry)
+        self.entry = None
+        self.LOADED.discard(self)
         self.reset_filters()
 
     def __repr__(self):
@@ -253,26 +2346,23 @@ class Sprite:
 
     @classmethod
     def from_asset(cls, asset_path):
-        asset = ET.ElementTree(file=asset_path).getroot()
-        path = asset.get(ns('sizechart', 'path'))
-        scale = float(asset.get(ns('sizechart', 'scale'), 1.0))
-        y = float(asset.get(ns('sizechart', 'offsetY'), 0.0))
-        ry = asset.get(ns('sizechart', 'referenceY'))
-        if ry is not None:
-            ry = float(ry)
-        nf = asset.get(ns('sizechart', 'minFilter'))
-        gf = asset.get(ns('sizechart', 'magFilter'))
-        ac = asset.get(ns('sizechart', 'averageColor'))
-        if ac is not None:
-            ac = tuple(int(i.strip()) for i in ac.split(','))
-        name = asset.get(ns('sizechart', 'name'), 'unnamed')
-        return cls(pyglet.image.load(path), path, scale,
-                y=y, refy=ry, name=name, asset=asset_path,
-                avg_color=ac, min_filter=nf, mag_filter=gf,
-        )
+        path, params = cls.asset_params(asset_path)
+        info = INFO.get(path)
+        if info is not None:
+            return cls.from_params(path, info['size'], lazy=True, **params)
+        return cls(IMAGES.acquire(path), path, **params)
+
+    @staticmethod
+    def asset_params(asset_path):
+        params = ASSETS[asset_path].params()
+        return params.pop('path'), dict(params, asset=asset_path)
 
     @classmethod
-    def from_element(cls, elem):
+    def from_element(cls, elem, lazy=False):
+        return cls.from_params(**cls.element_params(elem), lazy=lazy)
+
+    @staticmethod
+    def element_params(elem):
         path = None
         scale = None
         y = None
@@ -280,98 +2370,145 @@ class Sprite:
         ac = None
         nf, gf = None, None
         name = None
-        asset = elem.get(ns('sizechart', 'asset'))
+        asset = elem.get(SC.asset)
         print(f'spr asset {asset}')
         if asset:
             try:
-                et = ET.ElementTree(file=asset)
-            except FileNotFoundError:
+                p = ASSETS[asset].params()
+            except (FileNotFoundError, ET.ParseError):
                 pass
             else:
-                root = et.getroot()
-                path, scale, y, ry, name, ac, nf, gf = \
-                    root.get(ns('sizechart', 'path')), \
-                    float(root.get(ns('sizechart', 'scale'), 1.0)), \
-                    float(root.get(ns('sizechart', 'offsetY'), 0.0)), \
-                    root.get(ns('sizechart', 'referenceY')), \
-                    root.get(ns('sizechart', 'name'), 'unnamed'), \
-                    root.get(ns('sizechart', 'averageColor')), \
-                    root.get(ns('sizechart', 'minFilter')), \
-                    root.get(ns('sizechart', 'magFilter')),
-                if ry is not None:
-                    ry = float(ry)
+                path, scale, y, ry, name, ac, nf, gf = (p[k] for k in (
+                    'path', 'scale', 'y', 'refy', 'name', 'avg_color',
+                    'min_filter', 'mag_filter',
+                ))
                 print(f'asset results: {path},{scale},{y},{ry},{nf},{gf},{name}')
         if path is None:
-            path = elem.get('href', elem.get(ns('xlink', 'href')))
-        try:
-            surf = pyglet.image.load(path)
-        except FileNotFoundError:
-            surf = pyglet.image.create(
-                int(elem.get(ns('sizechart', 'origWidth'), 256)),
-                int(elem.get(ns('sizechart', 'origHeight'), 256)),
-                pyglet.image.CheckerImagePattern(
-                    (255, 0, 255, 255),
-                    (0, 0, 0, 255),
-                ),
+            path = elem.get('href', elem.get(XLINK.href))
+        orig_size = None
+        if elem.get(SC.origWidth) is not None:
+            orig_size = (
+                int(elem.get(SC.origWidth)),
+                int(elem.get(SC.origHeight, 256)),
             )
         if scale is None:
-            scale = float(elem.get(ns('sizechart', 'scale'), 1.0))
-        olap = float(elem.get(ns('sizechart', 'overlap'), 0.75))
+            scale = float(elem.get(SC.scale, 1.0))
+        olap = float(elem.get(SC.overlap, 0.75))
         if y is None:
-            y = float(elem.get(ns('sizechart', 'offsetY'), 0.0))
+            y = float(elem.get(SC.offsetY, 0.0))
         if ry is None:
-            ry = elem.get(ns('sizechart', 'referenceY'))
+            ry = elem.get(SC.referenceY)
             if ry is not None:
                 ry = float(ry)
         if nf is None:
-            nf = elem.get(ns('sizechart', 'minFilter'))
+            nf = elem.get(SC.minFilter)
         if gf is None:
-            gf = elem.get(ns('sizechart', 'magFilter'))
+            gf = elem.get(SC.magFilter)
         if name is None:
-            name = elem.get(ns('sizechart', 'name'), 'unnamed')
+            name = elem.get(SC.name, 'unnamed')
         if ac is None:
-            ac = elem.get(ns('sizechart', 'averageColor'))
-        if ac is not None:
-            ac = tuple(int(i.strip()) for i in ac.split(','))
+            ac = elem.get(SC.averageColor)
+            if ac is not None:
+                ac = tuple(int(i.strip()) for i in ac.split(','))
         print(f'sprite {path},{scale},{olap},{y},{ry},{name}')
-        return cls(surf, path, scale, olap, y, ry, name, asset, ac, gf, nf)
+        return dict(
+            path=path, orig_size=orig_size, scale=scale, olap=olap, y=y,
+            refy=ry, name=name, asset=asset, avg_color=ac,
+            mag_filter=gf, min_filter=nf,
+        )
 
-    @staticmethod
-    def average_color(img, ign_transp=True):
-        idata = img.get_image_data()
-        buffer = idata.get_data('RGBA', idata.width * 4)
-        pixels = array.array('I', buffer)
-        cavg = []
-        if ign_transp:
-            keep = lambda p: p & 0xff000000 > 0
-        else:
-            keep = lambda p: True
-        for cmp in range(4):
-            shift = 8 * cmp
-            mask = 0xff << shift
-            m, d = mean((i & mask) >> shift for i in pixels if keep(i))
-            print(f'avg {len(pixels)} px in depth {d}')
-            cavg.append(m)
+    # The from_params() arguments, in the order params() returns them
+    PARAMS = ('path', 'orig_size', 'scale', 'olap', 'y', 'refy', 'name',
+            'asset', 'avg_color', 'mag_filter', 'min_filter')
+
+    def params(self):
+        return (self.path, None if self.size is None else tuple(self.size),
+                self.scale, self.olap, self.y, self.refy, self.name,
+                self.asset, self.avg_col, self._mag_filter, self._min_filter)
 
+    # Whatever the info cache knows fills in for what the chart doesn't
+    @classmethod
+    def from_params(cls, path, orig_size, lazy=False, **params):
+        if orig_size is None or params.get('avg_color') is None:
+            info = INFO.get(path)
+            if info is not None:
+                orig_size = orig_size or info['size']
+                if params.get('avg_color') is None:
+                    params['avg_color'] = info['avg']
+        if lazy and orig_size is not None:
+            return cls(None, path, size=orig_size, **params)
+        try:
+            surf = IMAGES.acquire(path)
+        except FileNotFoundError:
+            surf = cls.missing(orig_size or (256, 256))
+        return cls(surf, path, **params)
+
+    AVG_CACHE = {}
+    @classmethod
+    def average_color(cls, img, path=None, ign_transp=True):
+        key = None
+        if path is not None:
+            try:
+                key = (file_key(path), ign_transp)
+            except OSError:
+                pass
+            else:
+                if key in cls.AVG_CACHE:
+                    return cls.AVG_CACHE[key]
+                info = INFO.get(path) if ign_transp else None
+                if info is not None:
+                    cls.AVG_CACHE[key] = info['avg']
+                    return info['avg']
+
+        idata = img.get_image_data()
+        w, h = idata.width, idata.height
+        buffer = idata.get_data('RGBA', w * 4)
+        if not isinstance(buffer, bytes):
+            buffer = bytes(buffer)
+        cavg = rgba_average(buffer, w, h, ign_transp)
         print(f'averages: {cavg}')
 
-        return tuple(int(i) for i in cavg[:3])
+        if key is not None:
+            cls.AVG_CACHE[key] = cavg
+        return cavg
 
-    REF_COLOR = (255, 0, 255)
-    def draw(self, canv, x, app):
-        self.lastx = x
-        self.sprite.update(
-            x = x,
-            y = self.y * self.scale,
-            scale = self.scale,
-        )
-        canv.draw_sprite(self.sprite)
+    @property
+    def width(self):
+        return self.scale * self.size.x
+
+    @property
+    def height(self):
+        return self.scale * self.size.y
 
+    @property
+    def x(self):
+        if self.layout is None:
+            return None
+        return self.layout.x_of(self)
+
+    # Only touches the vertex data when the layout actually moved us.
+    def place(self, x):
+        geom = (x, self.y * self.scale, self.scale)
+        if geom == self.geom:
+            return False
+        self.geom = geom
+        self.sprite.update(x=geom[0], y=geom[1], scale=geom[2])
+        return True
+
+    def attach(self, batch, group):
+        if self.sprite.batch is not batch:
+            self.sprite.batch = batch
+        if self.sprite.group is not group:
+            self.sprite.group = group
+
+    REF_COLOR = (255, 0, 255)
+    def draw(self, canv, app):
+        x = self.x
         if self.refy is not None:
             y = self.scale * (self.refy + self.y)
             canv.draw_line(
                 Vec2(x, y),
-                Vec2(x + self.sprite.width, y),
+                Vec2(x + self.width, y),
                 color = self.REF_COLOR,
             )
 
@@ -388,78 +2525,89 @@ class Sprite:
         canv.draw_text(
             self.name,
             Vec2(x, app.min_y),
-            color = self.avg_col,
+            color = self.avg_col or self.PLACEHOLDER_COLOR,
         )
 
-        return x + self.sprite.width * self.olap
-
     def box(self, canv, x, color=(255, 255, 255)):
         canv.draw_rect(pygame.Rect(
                 x, self.scale * self.y,
-                self.sprite.width,
-                self.sprite.height,
+                self.width,
+                self.height,
             ), color,
         )
 
     @property
     def rect(self):
-        if self.lastx is None:
+        x = self.x
+        if x is None:
             return
-        r = Rect(0, 0, self.sprite.width, self.sprite.height)
-        r.x = self.lastx
+        r = Rect(0, 0, self.width, self.height)
+        r.x = x
         r.y = self.scale * self.y
-        print(f'spr rect {r}')
         return r
 
     def contains(self, canv, spt, cpt):
         return self.rect.collidepoint(cpt)
 
-    def save(self, tb, vh):
+    @property
+    def bounds(self):
+        x, y = self.x, self.scale * self.y
+        return (x, y, x + self.width, y + self.height)
+
+    # Asset files are written right away if they've changed, or queued onto
+    # writes as {path: attrs} for ASSETS.write_all(); sprites sharing an asset
+    # overwrite each other's entry, so it's written once
+    def save(self, tb, vh, writes=None):
         if self.asset is not None:
-            asset = self.make_asset()
-            with open(self.asset, 'w') as f:
-                f.write(ET.tostring(asset, 'unicode'))
+            attrs = self.asset_attrs()
+            if writes is None:
+                if ASSETS[self.asset].dirty(attrs):
+                    ASSETS[self.asset].write(attrs)
+            else:
+                writes[os.path.abspath(self.asset)] = attrs
         attrs = {
                 'href': self.path,
-                'x': str(self.lastx),
-                'y': str(vh - self.scale * self.y - self.sprite.height),
-                'width': str(self.sprite.width),
-                'height': str(self.sprite.height),
-                ns('sizechart', 'origWidth'): str(self.sprite.image.width),
-                ns('sizechart', 'origHeight'): str(self.sprite.image.height),
-                ns('sizechart', 'scale'): str(self.scale),
-                ns('sizechart', 'overlap'): str(self.olap),
-                ns('sizechart', 'offsetY'): str(self.y),
-                ns('sizechart', 'averageColor'): ','.join(str(i) for i in self.avg_col),
-                ns('sizechart', 'name'): self.name,
-                ns('sizechart', 'role'): 'Sprite',
+                'x': str(self.x),
+                'y': str(vh - self.scale * self.y - self.height),
+                'width': str(self.width),
+                'height': str(self.height),
+                SC.origWidth: str(self.size.x),
+                SC.origHeight: str(self.size.y),
+                SC.scale: str(self.scale),
+                SC.overlap: str(self.olap),
+                SC.offsetY: str(self.y),
+                SC.name: self.name,
+                SC.role: 'Sprite',
         }
+        if self.avg_col is not None:
+            attrs[SC.averageColor] = ','.join(str(i) for i in self.avg_col)
         if self.refy is not None:
-            attrs[ns('sizechart', 'referenceY')] = str(self.refy)
+            attrs[SC.referenceY] = str(self.refy)
         if self._min_filter is not None:
-            attrs[ns('sizechart', 'minFilter')] = self._min_filter
+            attrs[SC.minFilter] = self._min_filter
         if self._mag_filter is not None:
-            attrs[ns('sizechart', 'magFilter')] = self._mag_filter
+            attrs[SC.magFilter] = self._mag_filter
         if self.asset is not None:
-            attrs[ns('sizechart', 'asset')] = self.asset
-        tb.start(ns('svg', 'image'), attrs)
-        tb.end(ns('svg', 'image'))
+            attrs[SC.asset] = self.asset
+        tb.start(SVG.image, attrs)
+        tb.end(SVG.image)
 
-    def make_asset(self):
+    def asset_attrs(self):
         attrs = {
-                ns('sizechart', 'path'): self.path,
-                ns('sizechart', 'scale'): str(self.scale),
-                ns('sizechart', 'offsetY'): str(self.y),
-                ns('sizechart', 'averageColor'): ','.join(str(i) for i in self.avg_col),
-                ns('sizechart', 'name'): self.name,
+                SC.path: self.path,
+                SC.scale: str(self.scale),
+                SC.offsetY: str(self.y),
+                SC.name: self.name,
         }
+        if self.avg_col is not None:
+            attrs[SC.averageColor] = ','.join(str(i) for i in self.avg_col)
         if self.refy is not None:
-            attrs[ns('sizechart', 'referenceY')] = str(self.refy)
+            attrs[SC.referenceY] = str(self.refy)
         if self._min_filter is not None:
-            attrs[ns('sizechart', 'minFilter')] = self._min_filter
+            attrs[SC.minFilter] = self._min_filter
         if self._mag_filter is not None:
-            attrs[ns('sizechart', 'magFilter')] = self._mag_filter
-        return ET.Element(ns('sizechart', 'asset'), attrs)
+            attrs[SC.magFilter] = self._mag_filter
+        return attrs
 
     @property
     def mag_filter(self): return self._mag_filter
@@ -475,23 +2623,37 @@ class Sprite:
         self.reset_filters()
 
     def reset_filters(self):
-        if self._min_filter is None and self._mag_filter is None:
-            return
-        tex = self.img.get_texture()
-        if isinstance(tex, pyglet.image.TextureRegion):
-            print(f'WARN: {tex} owned by {tex.owner}--this filter change may affect other sprits')
-            tex = tex.owner
-        glBindTexture(GL_TEXTURE_2D, tex.id)
-        if self._min_filter is not None:
-            nf = getattr(pyglet.gl, self._min_filter)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, nf)
-        if self._mag_filter is not None:
-            gf = getattr(pyglet.gl, self._mag_filter)
-            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, gf)
-        glBindTexture(GL_TEXTURE_2D, 0)
+        if self.entry is None:
+            tex = self.placeholder() if self.thumb is None else self.thumb
+        else:
+            tex = self.entry.texture(self._min_filter, self._mag_filter)
+        self.sprite.image = tex
+        self.sprite.update(
+            scale_x = self.size.x / tex.width,
+            scale_y = self.size.y / tex.height,
+        )
 
-class Viewport:
+    def delete(self):
+        self.sprite.delete()
+        if self.entry is not None:
+            IMAGES.release(self.entry)
+        self.LOADED.discard(self)
+
+    # Looks the same and shares the image, but isn't in any chart
+    def copy(self):
+        p = dict(zip(self.PARAMS, self.params()))
+        del p['orig_size']
+        spr = Sprite(None, p.pop('path'), size=self.size, **p)
+        if self.entry is not None:
+            IMAGES.retain(self.entry)
+            spr.set_entry(self.entry)
+        return spr
+
+class Viewport(Model):
     FBO = None
+    name = Field()
+    rect = Field()
+    scale = Field()
 
     def __init__(self, name, rect, scale=1.0):
         self.name = name
@@ -503,16 +2665,16 @@ class Viewport:
         return self.scale * Vec2(self.rect.w, self.rect.h)
 
     def save(self, tb):
-        tb.start(ns('sizechart', 'viewport'), {
+        tb.start(SC.viewport, {
             'x': str(self.rect.x),
             'y': str(self.rect.y),
             'width': str(self.rect.w),
             'height': str(self.rect.h),
             'scale': str(self.scale),
             'name': self.name,
-            ns('sizechart', 'role'): 'Viewport',
+            SC.role: 'Viewport',
         })
-        tb.end(ns('sizechart', 'viewport'))
+        tb.end(SC.viewport)
 
     @classmethod
     def from_element(cls, elem):
@@ -545,6 +2707,13 @@ class Viewport:
     def invalid(self):
         return self.rect.w <= 0 or self.rect.h <= 0
 
+    @property
+    def bounds(self):
+        r = self.rect
+        x0, x1 = sorted((r.x, r.x + r.w))
+        y0, y1 = sorted((r.y, r.y + r.h))
+        return (x0, y0, x1, y1)
+
     VP_COLOR = (0, 0, 255)
     VP_INVALID = (255, 0, 0)
     VP_SEL = (0, 255, 255)
@@ -592,48 +2761,674 @@ class Viewport:
             col,
         )
 
+    @property
+    def pixel_size(self):
+        s = self.render_size
+        s.x, s.y = (math.ceil(i) for i in s)
+        return s
+
+    # Renders bigger than this (or than GL allows) are done a tile at a time
+    TILE = 4096
+    @classmethod
+    def tile_size(cls):
+        limit = GLint(0)
+        glGetIntegerv(GL_MAX_TEXTURE_SIZE, byref(limit))
+        return min(cls.TILE, limit.value)
+
     def render(self, app):
         if self.invalid:
             return
+        if self.streamed:
+            run_job(app.render_viewports([self]))
+        else:
+            self.render_whole(app)
 
+    # Formats written a band at a time from the framebuffer bytes; anything
+    # else goes through pyglet
+    @property
+    def streamed(self):
+        return writer_for(self.name) is not None
+
+    # Points the canvas and GL at tex through the FBO, then puts everything
+    # back (the window may be drawn between tiles of a background render)
+    @staticmethod
+    @contextlib.contextmanager
+    def target(app, tex):
         if Viewport.FBO is None:
             Viewport.FBO = GLuint(0)
             glGenFramebuffers(1, byref(Viewport.FBO))
 
-        s = self.render_size
-        s.x, s.y = (math.ceil(i) for i in s)
         glBindFramebuffer(GL_FRAMEBUFFER, Viewport.FBO)
-        tex = pyglet.image.Texture.create(s.x, s.y)
         glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, tex.id, 0)
-        
-        old_scale = app.canvas.scale
-        old_origin = app.canvas.origin
-        app.canvas.scale = self.scale
-        app.canvas.origin = Vec2(self.rect.x, self.rect.y)
-        app.canvas.target_size = self.render_size
-        app.canvas.disp.projection.set(s.x, s.y, s.x, s.y)
-        app.render(RenderState.IMAGE)
-        app.canvas.disp.projection.set(
-            *app.canvas.disp.get_size(),
-            *app.canvas.disp.get_framebuffer_size(),
-        )
-        app.canvas.target_size = None
-        app.canvas.origin = old_origin
-        app.canvas.scale = old_scale
 
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
-        glViewport(0, 0, *app.canvas.view_size)
+        canv = app.canvas
+        old_scale = canv.scale
+        old_origin = canv.origin
+        try:
+            yield tex
+        finally:
+            canv.disp.projection.set(
+                *canv.disp.get_size(),
+                *canv.disp.get_framebuffer_size(),
+            )
+            canv.target_size = None
+            canv.origin = old_origin
+            canv.scale = old_scale
+            glBindFramebuffer(GL_FRAMEBUFFER, 0)
+            glViewport(0, 0, *canv.view_size)
+
+    # The lower left corner of the whole output, where labels that follow the
+    # edge of the view are pinned; every tile gets the same one
+    @property
+    def anchor(self):
+        return Vec2(self.rect.x, self.rect.y)
+
+    # Renders the w x h pixels whose lower left corner is px, py pixels into
+    # the output, into the lower left of the target
+    def render_tile(self, app, px, py, w, h, anchor):
+        canv = app.canvas
+        canv.scale = self.scale
+        canv.origin = Vec2(self.rect.x + px / self.scale, self.rect.y + py / self.scale)
+        canv.target_size = Vec2(w, h)
+        canv.disp.projection.set(w, h, w, h)
+        box = canv.view_bounds
+        app.ensure_loaded(box)
+        app.render(RenderState.IMAGE, box, anchor)
+
+    def render_whole(self, app):
+        s = self.pixel_size
+        tex = pyglet.image.Texture.create(s.x, s.y)
+        with self.target(app, tex):
+            self.render_tile(app, 0, 0, s.x, s.y, self.anchor)
         tex.save(self.name)
 
+    # The output is rendered in bands of whole rows, top to bottom, each made
+    # of tiles side by side; yields (py, h, [(px, w), ...]).
+    BAND_BYTES = 1 << 26
+    def bands(self, tile):
+        s = self.pixel_size
+        bh = max(1, min(tile, s.y, self.BAND_BYTES // (4 * s.x)))
+        cols = [(px, min(tile, s.x - px)) for px in range(0, s.x, tile)]
+        top = s.y
+        while top > 0:
+            h = min(bh, top)
+            yield top - h, h, cols
+            top -= h
+
+# Rows of one output band, filled in as its tiles are read back
+class Band:
+    def __init__(self, width, h, tiles):
+        self.stride = 4 * width
+        self.h = h
+        self.left = tiles
+        self.data = bytearray(self.stride * h)
+
+    # Returns True once the last tile is in
+    def put(self, px, w, pixels):
+        for row in range(self.h):
+            d = row * self.stride + 4 * px
+            self.data[d:d + 4 * w] = pixels[4 * w * row:4 * w * (row + 1)]
+        self.left -= 1
+        return self.left == 0
+
+    # GL reads bottom up; PNG goes top down
+    def rows(self):
+        data = memoryview(self.data)
+        return (data[self.stride * row:self.stride * (row + 1)] for row in reversed(range(self.h)))
+
+# Reads tiles back through a ring of pixel buffers: glReadPixels into one
+# returns at once, and its pixels are only mapped when the ring comes back
+# around to it, by which time the GPU has usually finished the copy.
+class Readback:
+    RING = 2
+
+    def __init__(self, nbytes, ring=RING):
+        self.ids = (GLuint * ring)()
+        glGenBuffers(ring, self.ids)
+        for buf in self.ids:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, buf)
+            glBufferData(GL_PIXEL_PACK_BUFFER, nbytes, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.next = 0
+        self.queue = collections.deque()
+
+    # Reads the lower left w x h of the framebuffer; done(pixels) is called
+    # once they've been mapped
+    def start(self, w, h, done):
+        if len(self.queue) == len(self.ids):
+            self.finish()
+        buf = self.ids[self.next]
+        self.next = (self.next + 1) % len(self.ids)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, buf)
+        glReadPixels(0, 0, w, h, GL_RGBA, GL_UNSIGNED_BYTE, 0)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.queue.append((buf, 4 * w * h, done))
+
+    def finish(self):
+        buf, n, done = self.queue.popleft()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, buf)
+        ptr = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        try:
+            done(memoryview((GLubyte * n).from_address(ptr)).cast('B'))
+        finally:
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def flush(self):
+        while self.queue:
+            self.finish()
+
+    # Pending reads are dropped unless flush is set
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        self.queue.clear()
+        glDeleteBuffers(len(self.ids), self.ids)
+
+# One viewport on its way to disk: its bands are encoded in order on the
+# shared pool while the GPU goes on to the next ones.
+class Export:
+    def __init__(self, vp, pool=None, backlog=None):
+        self.vp = vp
+        self.size = vp.pixel_size
+        self.start = time.perf_counter()
+        self.render_time = 0.0
+        self.encode_time = 0.0
+        self.end = None
+        self.done = None
+        self.queue = self.out = None
+        if pool is not None:
+            self.queue = SerialQueue(pool)
+            self.out = writer_for(vp.name)(vp.name, self.size.x, self.size.y, pool=deflaters())
+        self.backlog = backlog
+        self.bands_left = 0
+
+    # Readback callback for one tile of band; the file is closed behind the
+    # last band
+    def take(self, band, px, w, pixels):
+        if band.put(px, w, pixels):
+            self.backlog.append(self.queue.submit(self.encode, band))
+            self.bands_left -= 1
+            if self.bands_left == 0:
+                self.done = self.queue.submit(self.close)
+                self.backlog.append(self.done)
+
+    def encode(self, band):
+        start = time.perf_counter()
+        self.out.write_rows(band.rows())
+        self.encode_time += time.perf_counter() - start
+
+    def abort(self):
+        if self.out is not None and self.done is None:
+            self.queue.submit(self.out.abort).result()
+
+    def close(self):
+        start = time.perf_counter()
+        self.out.close()
+        self.encode_time += time.perf_counter() - start
+        self.end = time.perf_counter()
+
+    @property
+    def pixels(self):
+        return self.size.x * self.size.y
+
+    def report(self):
+        wall = self.end - self.start
+        return (f'{self.vp.name}: {wall:.3f}s '
+                f'(render {self.render_time:.3f}s, encode {self.encode_time:.3f}s, '
+                f'{si(self.pixels / wall)}px/s)')
+
+class Job:
+    def __init__(self, name, gen, done=None):
+        self.name = name
+        self.gen = gen
+        self.done = done
+        self.progress = None
+        self.waiting = None
+        self.start = time.perf_counter()
+
+    @property
+    def status(self):
+        if isinstance(self.progress, float):
+            return f'{self.name}: {self.progress:.0%}'
+        if self.progress is None:
+            return f'{self.name}...'
+        return f'{self.name}: {self.progress}'
+
+# Long operations are generators run a slice at a time on the main thread, so
+# they're free to touch GL while the window stays responsive. A job yields a
+# Future to sleep until it's done (and gets its result, or its exception,
+# back), or anything else as its progress so far. Whatever the generator
+# returns is passed to the job's done callback.
+class Jobs:
+    SLICE = 0.02
+
+    def __init__(self, app):
+        self.app = app
+        self.jobs = []
+        self.scheduled = False
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(self.jobs)
+
+    def start(self, name, gen, done=None):
+        job = Job(name, gen, done)
+        self.jobs.append(job)
+        self.schedule()
+        return job
+
+    def schedule(self):
+        if self.jobs and not self.scheduled:
+            self.scheduled = True
+            pyglet.clock.schedule_once(self.tick, 0)
+
+    def cancel(self, job):
+        if job not in self.jobs:
+            return
+        self.jobs.remove(job)
+        if job.waiting is not None:
+            job.waiting.cancel()
+        job.gen.close()
+        self.app.message = f'Cancelled {job.name}'
+
+    def cancel_all(self):
+        for job in self.jobs[:]:
+            self.cancel(job)
+
+    def tick(self, dt=0):
+        self.scheduled = False
+        deadline = time.perf_counter() + self.SLICE
+        runnable = True
+        while runnable and time.perf_counter() < deadline:
+            runnable = False
+            for job in self.jobs[:]:
+                runnable |= self.step(job)
+        self.app.invalidate()
+        if runnable:
+            self.schedule()
+
+    # Returns whether the job can go on right away
+    def step(self, job):
+        try:
+            if job.waiting is not None:
+                fut = job.waiting
+                if not fut.done():
+                    return False
+                job.waiting = None
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    out = job.gen.throw(e)
+                else:
+                    out = job.gen.send(res)
+            else:
+                out = job.gen.send(None)
+        except StopIteration as stop:
+            self.jobs.remove(job)
+            if job.done is not None:
+                job.done(stop.value)
+            return False
+        except Exception as e:
+            traceback.print_exc()
+            self.jobs.remove(job)
+            self.app.message = f'{job.name} failed: {e!r}'
+            return False
+        if isinstance(out, concurrent.futures.Future):
+            job.waiting = out
+            if not out.done():
+                out.add_done_callback(lambda f: self.app.wake())
+                return False
+        else:
+            job.progress = out
+        return True
+
+pyglet.window.Window.register_event_type('on_wake')
+
 class Event:
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+# What Y last copied, kept live next to the XML it wrote to CLIP_FILE. Pasting
+# in this process copies the sprites' settings and shares their decoded images
+# (which it holds on to) instead of reading anything again. It's only trusted
+# while CLIP_FILE is still what it wrote there.
+class Clip:
+    def __init__(self, text, elements):
+        clip_copy(text)
+        self.stamp = file_stamp(CLIP_FILE)
+        self.items = []
+        for elem in elements:
+            if isinstance(elem, Sprite):
+                if elem.entry is not None:
+                    IMAGES.retain(elem.entry)
+                self.items.append(('Sprite', elem.params(), elem.entry))
+            elif isinstance(elem, Viewport):
+                r = elem.rect
+                self.items.append(('Viewport', (elem.name, (r.x, r.y, r.w, r.h), elem.scale), None))
+
+    def current(self):
+        return self.stamp is not None and file_stamp(CLIP_FILE) == self.stamp
+
+    def paste(self):
+        for role, data, entry in self.items:
+            if role == 'Viewport':
+                name, rect, scale = data
+                yield Viewport(name, Rect(*rect), scale)
+                continue
+            params = dict(zip(Sprite.PARAMS, data))
+            if entry is None:
+                yield Sprite.from_params(**params, lazy=True)
+            else:
+                IMAGES.retain(entry)
+                del params['orig_size']
+                yield Sprite(entry, params.pop('path'), **params)
+
+    def release(self):
+        for _, _, entry in self.items:
+            if entry is not None:
+                IMAGES.release(entry)
+        self.items = []
+
+# Undo history as field-level diffs: entry k says field names[fields[k]] of
+# object objs[oids[k]] went from olds[k] to news[k]. Fields starting with '@'
+# are structural: '@index' is a sprite's place in the chart and '@viewport' a
+# viewport's place in the viewport list (None when out of it). Entries since
+# the last commit() make up the open transaction, in which repeated changes to
+# a field collapse into one entry, so a whole drag costs one entry per object.
+# Committed transactions start at starts[t]; the first done are applied.
+#
+# Committed transactions are also appended to CHART.journal, against the chart
+# as it was loaded or saved, so a crash loses nothing: attach() replays them.
+class Journal:
+    BUDGET = 16 << 20
+    # Rough cost of one entry, values included
+    ENTRY_BYTES = 96
+    MAGIC = 'sizechart-journal-2'
+    # Worked out from the image, not edited
+    DERIVED = frozenset({'size', 'avg_col'})
+
+    def __init__(self, app):
+        self.app = app
+        self.budget = self.BUDGET
+        self.objs, self.oid = [], {}
+        self.names, self.fid = [], {}
+        self.oids, self.fields = array.array('L'), array.array('H')
+        self.olds, self.news = [], []
+        self.starts = array.array('L')
+        self.done = 0
+        self.mark = 0
+        self.open = {}
+        self.quiet = 0
+        self.path = None
+        self.file = None
+        self.file_ids = {}
+        Model.observers.append(self.changed)
+
+    def __len__(self):
+        return len(self.olds)
+
+    @contextlib.contextmanager
+    def paused(self):
+        self.quiet += 1
+        try:
+            yield
+        finally:
+            self.quiet -= 1
+
+    def changed(self, obj, field, old, new):
+        if field not in self.DERIVED:
+            self.record(obj, field, old, new)
+
+    def record(self, obj, field, old, new):
+        if self.quiet:
+            return
+        if self.done < len(self.starts):
+            self.cut(self.done, len(self.starts))
+        o = self.oid.get(obj)
+        if o is None:
+            o = self.oid[obj] = len(self.objs)
+            self.objs.append(obj)
+        f = self.fid.get(field)
+        if f is None:
+            f = self.fid[field] = len(self.names)
+            self.names.append(field)
+        if not field.startswith('@'):
+            k = self.open.get((o, f))
+            if k is not None:
+                self.news[k] = new
+                return
+            self.open[(o, f)] = len(self.olds)
+        self.oids.append(o)
+        self.fields.append(f)
+        self.olds.append(old)
+        self.news.append(new)
+
+    def entries(self, start, end):
+        return zip(self.oids[start:end], self.fields[start:end], self.olds[start:end], self.news[start:end])
+
+    # Closes the open transaction, less anything that ended up where it began
+    # (viewports added and taken away again, with all that happened to them)
+    def commit(self):
+        self.open.clear()
+        if len(self) == self.mark:
+            return
+        entries = list(self.entries(self.mark, len(self)))
+        f = self.fid.get('@viewport')
+        first, last = {}, {}
+        for o, fo, old, new in entries:
+            if fo == f:
+                first.setdefault(o, old)
+                last[o] = new
+        gone = {o for o in first if first[o] is None and last[o] is None}
+        kept = [e for e in entries if e[2] != e[3] and e[0] not in gone]
+        self.truncate(self.mark)
+        for o in gone.difference(self.oids):
+            self.release(o)
+        if not kept:
+            return
+        for o, f, old, new in kept:
+            self.oids.append(o)
+            self.fields.append(f)
+            self.olds.append(old)
+            self.news.append(new)
+        self.starts.append(self.mark)
+        self.done = len(self.starts)
+        self.mark = len(self)
+        self.write([(o, f, old, new) for o, f, old, new in kept])
+        self.trim()
+
+    def truncate(self, end):
+        del self.oids[end:], self.fields[end:], self.olds[end:], self.news[end:]
+
+    # Forgets transactions first..last-1 (which must be the oldest or the
+    # newest), letting go of objects nothing else refers to
+    def cut(self, first, last):
+        start = self.starts[first]
+        end = self.starts[last] if last < len(self.starts) else self.mark
+        gone = set(self.oids[start:end])
+        if last == len(self.starts):
+            self.truncate(start)
+            del self.starts[first:]
+            self.done = min(self.done, first)
+            self.mark = start
+        else:
+            del self.oids[:end], self.fields[:end], self.olds[:end], self.news[:end]
+            self.starts = array.array('L', (s - end for s in self.starts[last:]))
+            self.done -= last
+            self.mark -= end
+        self.open.clear()
+        for o in gone.difference(self.oids):
+            self.release(o)
+
+    def release(self, o):
+        obj = self.objs[o]
+        self.objs[o] = None
+        del self.oid[obj]
+        if isinstance(obj, Sprite) and obj.layout is None:
+            obj.delete()
+
+    # Drops the oldest transactions once over budget, down to 3/4 of it
+    def trim(self):
+        if len(self) * self.ENTRY_BYTES <= self.budget:
+            return
+        keep = self.budget * 3 // 4 // self.ENTRY_BYTES
+        t = 0
+        while t < self.done - 1 and len(self) - self.starts[t] > keep:
+            t += 1
+        if t:
+            self.cut(0, t)
+
+    def clear(self):
+        self.commit()
+        if self.starts:
+            self.cut(0, len(self.starts))
+        self.objs, self.oid = [], {}
+        self.done = 0
+
+    def apply(self, o, f, value):
+        obj, name = self.objs[o], self.names[f]
+        with self.paused():
+            if name == '@index':
+                self.app.place_sprite(obj, value)
+            elif name == '@viewport':
+                self.app.place_viewport(obj, value)
+            else:
+                self.set_field(obj, name, value)
+
+    # Through the property if there is one (filters need it)
+    @staticmethod
+    def set_field(obj, name, value):
+        prop = name.lstrip('_')
+        if isinstance(getattr(type(obj), prop, None), property):
+            name = prop
+        setattr(obj, name, value)
+
+    def undo(self):
+        self.commit()
+        if not self.done:
+            return 0
+        t = self.done - 1
+        end = self.starts[t + 1] if t + 1 < len(self.starts) else self.mark
+        changes = list(self.entries(self.starts[t], end))[::-1]
+        for o, f, old, new in changes:
+            self.apply(o, f, old)
+        self.done = t
+        self.write([(o, f, new, old) for o, f, old, new in changes])
+        return len(changes)
+
+    def redo(self):
+        self.commit()
+        if self.done == len(self.starts):
+            return 0
+        t = self.done
+        end = self.starts[t + 1] if t + 1 < len(self.starts) else self.mark
+        changes = list(self.entries(self.starts[t], end))
+        for o, f, old, new in changes:
+            self.apply(o, f, new)
+        self.done = t + 1
+        self.write(changes)
+        return len(changes)
+
+    # Journal files refer to the chart's objects by their order in it (sprites,
+    # then viewports), and to ones made since by ids given in 'c' records
+    # keep=False removes the previous journal, once a save has covered it
+    def attach(self, path, recover=True, keep=True):
+        self.close(keep=keep)
+        self.path = path
+        if path is None:
+            return 0
+        app = self.app
+        self.file_ids = {obj: i for i, obj in enumerate(itertools.chain(app.sprites, app.viewports))}
+        header = (self.MAGIC, file_stamp(path))
+        jpath = path + '.journal'
+        records = []
+        if recover:
+            try:
+                with open(jpath, 'rb') as f:
+                    if marshal.load(f) == header:
+                        while True:
+                            records.append(marshal.load(f))
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        recovered = 0
+        objs = {i: obj for obj, i in self.file_ids.items()}
+        for rec in records:
+            if rec[0] == 'c':
+                _, i, role, data = rec
+                if role == 'Sprite':
+                    obj = Sprite.from_params(**dict(zip(Sprite.PARAMS, data)), lazy=True)
+                else:
+                    name, rect, scale = data
+                    obj = Viewport(name, Rect(*rect), scale)
+                objs[i] = obj
+                self.file_ids[obj] = i
+            else:
+                for i, name, old, new in rec[1]:
+                    if name == 'rect':
+                        new = Rect(*new)
+                    if name == '@index':
+                        app.place_sprite(objs[i], new)
+                    elif name == '@viewport':
+                        app.place_viewport(objs[i], new)
+                    else:
+                        self.set_field(objs[i], name, new)
+                self.commit()
+                recovered += 1
+        try:
+            if records:
+                self.file = open(jpath, 'ab')
+            else:
+                self.file = open(jpath, 'wb')
+                marshal.dump(header, self.file)
+                self.file.flush()
+        except OSError as e:
+            print(f'No journal: {e}')
+            self.file = None
+        return recovered
+
+    def write(self, changes):
+        if self.file is None:
+            return
+        try:
+            out = []
+            for o, f, old, new in changes:
+                obj, name = self.objs[o], self.names[f]
+                i = self.file_ids.get(obj)
+                if i is None:
+                    i = self.file_ids[obj] = len(self.file_ids)
+                    if isinstance(obj, Sprite):
+                        data = ('Sprite', obj.params())
+                    else:
+                        r = obj.rect
+                        data = ('Viewport', (obj.name, (r.x, r.y, r.w, r.h), obj.scale))
+                    marshal.dump(('c', i, *data), self.file)
+                if name == 'rect':
+                    old, new = (old.x, old.y, old.w, old.h), (new.x, new.y, new.w, new.h)
+                out.append((i, name, old, new))
+            marshal.dump(('t', out), self.file)
+            self.file.flush()
+        except (OSError, ValueError) as e:
+            print(f'Journal stopped: {e}')
+            self.file = None
+
+    # Removes the journal file unless keep (i.e. there's something unsaved)
+    def close(self, keep):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            if not keep:
+                with contextlib.suppress(OSError):
+                    os.remove(self.path + '.journal')
+
 class App:
     def __init__(self, screen, default_file='chart.svg'):
         self.canvas = Canvas(screen)
-        self.sprites = []
+        self.sprites = Layout()
         self.viewports = []
         self.selection = []
         self.running = True
@@ -644,10 +3439,30 @@ class App:
         self.unit = 'm'
         self.capture = False
         self.buffer = ''
+        self.dirty = True
+        self.last_frame = 0.0
+        self.redraw_pending = False
         self.message = ''
         self.default_file = default_file
         self.mpos = Vec2()
         self.mods = 0
+        self.canvas.on_change = self.invalidate
+        Model.observers.append(self.model_changed)
+        self.sprite_batch = pyglet.graphics.Batch()
+        self.sprite_layers = []
+        self.vp_index = SpatialIndex()
+        self.shown = set()
+        self.loading = set()
+        pyglet.clock.schedule_interval(self.evict_far, self.EVICT_CHECK)
+        self.cull_stats = {}
+        self.report = None
+        self.clip = None
+        self.journal = Journal(self)
+        self.sprites.on_change = self.sprite_moved
+        self.jobs = Jobs(self)
+        self.edits = 0
+        self.saved = None
+        self.grids = {}
         screen.push_handlers(
             on_key_press = self.ev_key_press,
             on_key_release = self.ev_key_release,
@@ -658,39 +3473,164 @@ class App:
             on_mouse_motion = self.ev_mouse_motion,
             on_mouse_drag = self.ev_mouse_drag,
             on_mouse_scroll = self.ev_mouse_scroll,
-            on_draw = self.render,
+            on_draw = self.ev_draw,
+            on_wake = self.ev_wake,
+            on_resize = self.ev_resize,
+            on_expose = self.invalidate,
         )
 
-    def save_tree(self):
+    @property
+    def message(self):
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+        self.invalidate()
+
+    # Nothing is drawn unless something invalidated the scene. While one of
+    # these modes is following the mouse, redraws are held to INTERACTIVE_FPS.
+    INTERACTIVE = {
+        'ks_dragging', 'ks_move', 'ks_scale', 'ks_offset', 'ks_reference',
+        'ks_viewport', 'ks_vp_opposite', 'ks_vp_origin', 'ks_vp_scale',
+    }
+    INTERACTIVE_FPS = 60
+    def invalidate(self):
+        self.dirty = True
+        if self.redraw_pending:
+            return
+        if self.INTERACTIVE_FPS and self.keystate.__name__ in self.INTERACTIVE:
+            wait = self.last_frame + 1 / self.INTERACTIVE_FPS - time.monotonic()
+            if wait > 0:
+                self.redraw_pending = True
+                pyglet.clock.schedule_once(self.redraw, wait)
+                return
+        self.canvas.disp.invalid = True
+
+    def redraw(self, dt=0):
+        self.redraw_pending = False
+        self.canvas.disp.invalid = True
+
+    # Changes whenever anything that gets saved (besides the view) does
+    @property
+    def revision(self):
+        return self.edits + self.sprites.revision
+
+    # The canvas position saved alongside; a save is only a no-op if both match
+    @property
+    def view(self):
+        return (self.canvas.origin[0], self.canvas.origin[1], self.canvas.scale)
+
+    def model_changed(self, obj, field, old, new):
+        if field == 'rect' and obj in self.vp_index.entries:
+            self.vp_index.update(obj, obj.bounds, self.vp_index.entries[obj][1])
+        self.edits += 1
+        self.invalidate()
+
+    def add_viewport(self, vp, index=None):
+        self.edits += 1
+        if index is None:
+            index = len(self.viewports)
+        self.viewports.insert(index, vp)
+        self.rank_viewports(index)
+        self.journal.record(vp, '@viewport', None, index)
+
+    def remove_viewport(self, vp):
+        self.edits += 1
+        index = self.viewports.index(vp)
+        del self.viewports[index]
+        self.vp_index.remove(vp)
+        self.rank_viewports(index)
+        self.remove_selection(vp)
+        self.journal.record(vp, '@viewport', index, None)
+
+    # Earlier viewports win hit tests
+    def rank_viewports(self, start=0):
+        for i in range(start, len(self.viewports)):
+            vp = self.viewports[i]
+            self.vp_index.update(vp, vp.bounds, -i)
+
+    # Sprites out of the chart stay alive (hidden, with their image let go)
+    # while the journal can still bring them back
+    def sprite_moved(self, spr, old, new):
+        if new is None:
+            spr.sprite.visible = False
+            spr.unload()
+            self.shown.discard(spr)
+            self.loading.discard(spr)
+            self.remove_selection(spr)
+        self.journal.record(spr, '@index', old, new)
+
+    def place_sprite(self, spr, index):
+        if index is None:
+            self.sprites.remove(spr)
+        elif spr.layout is not self.sprites:
+            self.sprites.insert(index, spr)
+        else:
+            self.sprites.move(spr, index)
+
+    def place_viewport(self, vp, index):
+        if index is None:
+            if vp in self.viewports:
+                self.remove_viewport(vp)
+        elif vp not in self.viewports:
+            self.add_viewport(vp, index)
+
+    # Whatever an event did is one undo step once it leaves the default mode
+    # (so a drag in some mode is undone as a whole)
+    def dispatch(self, ev):
+        self.keystate(ev)
+        if self.keystate == self.ks_default:
+            self.journal.commit()
+        self.invalidate()
+
+    def ev_draw(self):
+        self.render()
+        self.dirty = False
+        self.last_frame = time.monotonic()
+        self.canvas.disp.invalid = False
+
+    def ev_resize(self, width, height):
+        self.invalidate()
+
+    def save_tree(self, writes=None):
         tb = ET.TreeBuilder()
+        run_job(self.write_chart(tb, writes))
+        return ET.ElementTree(tb.close())
 
+    SAVE_BATCH = 256
+
+    # Emits the chart into tb (a TreeBuilder or SVGWriter), yielding progress
+    # every SAVE_BATCH sprites
+    def write_chart(self, tb, writes=None):
         r = Rect(0, 0, 1, 1)
         for spr in self.sprites:
             r.union_ip(spr.rect)
         vh = r.h
         vb = f'0 0 {r.w - r.x} {r.h - r.y}'
 
-        tb.start(ns('svg', 'svg'), {
-            ns('svg', 'viewbox'): vb,
+        tb.start(SVG.svg, {
+            SVG.viewbox: vb,
             'width': str(r.w - r.x),
             'height': str(r.h - r.y),
             # 'style': 'background-color: #000;',
-            ns('sizechart', 'ppu'): str(self.ppu),
-            ns('sizechart', 'unit'): self.unit,
-            ns('sizechart', 'canvasX'): str(self.canvas.origin[0]),
-            ns('sizechart', 'canvasY'): str(self.canvas.origin[1]),
-            ns('sizechart', 'canvasScale'): str(self.canvas.scale),
+            SC.ppu: str(self.ppu),
+            SC.unit: self.unit,
+            SC.canvasX: str(self.canvas.origin[0]),
+            SC.canvasY: str(self.canvas.origin[1]),
+            SC.canvasScale: str(self.canvas.scale),
         })
 
         self.svg_scale(tb, r)
 
-        for spr in self.sprites:
-            spr.save(tb, vh)
+        for i, spr in enumerate(self.sprites, 1):
+            spr.save(tb, vh, writes)
+            if i % self.SAVE_BATCH == 0:
+                yield i / len(self.sprites)
         for vp in self.viewports:
             vp.save(tb)
 
-        tb.end(ns('svg', 'svg'))
-        return ET.ElementTree(tb.close())
+        tb.end(SVG.svg)
 
     def svg_scale(self, tb, r):
         major = set()
@@ -699,7 +3639,7 @@ class App:
             major.add(y)
         for y in steps(0, r.h / self.ppu, 1.25):
             sy = r.h - y * self.ppu
-            tb.start(ns('svg', 'line'), {
+            tb.start(SVG.line, {
                 'x1': '0',
                 'x2': str(fw),
                 'y1': str(sy),
@@ -707,8 +3647,8 @@ class App:
                 'stroke': '#077' if abs(y) < 0.001 else '#770',
                 'stroke-width': '3' if y in major else '1',
             })
-            tb.end(ns('svg', 'line'))
-            tb.start(ns('svg', 'text'), {
+            tb.end(SVG.line)
+            tb.start(SVG.text, {
                 'x': '0',
                 'y': str(sy),
                 'dominant-baseline': 'hanging',
@@ -716,31 +3656,101 @@ class App:
                 'dy': '3',
             })
             tb.data(f'{y}{self.unit}')
-            tb.end(ns('svg', 'text'))
-
-    def load_tree(self, root):
-        self.ppu = float(root.get(ns('sizechart', 'ppu'), self.ppu))
-        self.unit = root.get(ns('sizechart', 'unit'), self.unit)
-        self.canvas.origin = Vec2(
-            float(root.get(ns('sizechart', 'canvasX'), self.canvas.origin[0])),
-            float(root.get(ns('sizechart', 'canvasY'), self.canvas.origin[1])),
-        )
-        self.canvas.scale = float(root.get(
-            ns('sizechart', 'canvasScale'),
-            self.canvas.scale,
-        ))
+            tb.end(SVG.text)
+
+    SIDECAR = False
+
+    # With SIDECAR, a path is loaded from its sidecar when that's still good,
+    # and gets a fresh one when it isn't
+    def load_chart(self, source):
+        with self.journal.paused():
+            sidecar = self.SIDECAR and isinstance(source, str)
+            if sidecar:
+                snap = read_sidecar(source)
+                if snap is not None:
+                    print(f'Loading {source} from sidecar')
+                    return self.load_snapshot(snap)
+                stamp = file_stamp(source)
+            self.load_tree(*iter_children(source))
+            if sidecar:
+                encoders().submit(write_sidecar, source, self.snapshot(source, stamp))
+
+    def reset_chart(self, ppu, unit, origin, scale):
+        self.journal.clear()
+        self.ppu, self.unit = ppu, unit
+        self.canvas.origin = origin
+        self.canvas.scale = scale
+        for spr in self.sprites:
+            spr.delete()
         del self.sprites[:]
-        for child in root:
-            role = child.get(ns('sizechart', 'role'))
+
+    def load_tree(self, root, children=None):
+        self.reset_chart(
+            float(root.get(SC.ppu, self.ppu)),
+            root.get(SC.unit, self.unit),
+            Vec2(
+                float(root.get(SC.canvasX, self.canvas.origin[0])),
+                float(root.get(SC.canvasY, self.canvas.origin[1])),
+            ),
+            float(root.get(SC.canvasScale, self.canvas.scale)),
+        )
+        # Sprites that know their size (or whose size the info cache knows)
+        # are built as they're read and wait until they're on screen to
+        # decode. Ones that don't are decoded on
+        # the pool while the rest of the chart is read. Those, and any after
+        # them, are built at the end so document order is kept.
+        waiting = []
+        for child in (root if children is None else children):
+            role = child.get(SC.role)
             if role == 'Sprite':
-                self.sprites.append(Sprite.from_element(child))
+                p = Sprite.element_params(child)
+                if p['orig_size'] is None and not INFO.has(p['path']):
+                    IMAGES.prefetch(p['path'], p['avg_color'] is None)
+                    waiting.append(p)
+                elif waiting:
+                    waiting.append(p)
+                else:
+                    self.sprites.append(Sprite.from_params(**p, lazy=True))
             elif role == 'Viewport':
-                self.viewports.append(Viewport.from_element(child))
+                self.add_viewport(Viewport.from_element(child))
+        self.sprites.extend(Sprite.from_params(**p, lazy=True) for p in waiting)
         print('Post-load:', self.sprites)
 
+    # Plain data only, so it can be marshalled into a sidecar. stamp is the
+    # chart's from before it was read or after it was written; assets are
+    # stamped as they were last read, and images here and now, so nothing
+    # that changes later can vouch for this snapshot.
+    def snapshot(self, path, stamp):
+        deps = {path: stamp}
+        for spr in self.sprites:
+            if spr.path not in deps:
+                deps[spr.path] = file_stamp(spr.path)
+            if spr.asset and spr.asset not in deps:
+                seen = ASSETS[spr.asset].stamp
+                deps[spr.asset] = file_stamp(spr.asset) if seen is None else seen
+        return {
+            'root': (self.ppu, self.unit, *self.canvas.origin, self.canvas.scale),
+            'sprites': [spr.params() for spr in self.sprites],
+            'viewports': [
+                (vp.name, (vp.rect.x, vp.rect.y, vp.rect.w, vp.rect.h), vp.scale)
+                for vp in self.viewports
+            ],
+            'deps': list(deps.items()),
+        }
+
+    def load_snapshot(self, snap):
+        ppu, unit, cx, cy, scale = snap['root']
+        self.reset_chart(ppu, unit, Vec2(cx, cy), scale)
+        for name, rect, vscale in snap['viewports']:
+            self.add_viewport(Viewport(name, Rect(*rect), vscale))
+        self.sprites.extend(
+            Sprite.from_params(**dict(zip(Sprite.PARAMS, p)), lazy=True)
+            for p in snap['sprites']
+        )
+
     def export(self, elements):
         tb = ET.TreeBuilder()
-        tb.start(ns('sizechart', 'clip'), {})
+        tb.start(SC.clip, {})
         for elem in elements:
             if isinstance(elem, Sprite):
                 elem.save(tb, 0)
@@ -748,93 +3758,308 @@ class App:
                 elem.save(tb)
             else:
                 raise TypeError(type(elem))
-        tb.end(ns('sizechart', 'clip'))
+        tb.end(SC.clip)
         return ET.ElementTree(tb.close())
 
-    def import_(self, root):
-        valid = 0
-        for child in root:
-            role = child.get(ns('sizechart', 'role'))
+    def import_(self, source):
+        return self.paste(self.clip_objects(source))
+
+    @staticmethod
+    def clip_objects(source):
+        _, children = iter_children(source)
+        for child in children:
+            role = child.get(SC.role)
             if role == 'Sprite':
-                self.sprites.append(Sprite.from_element(child))
-                valid += 1
+                yield Sprite.from_element(child, lazy=True)
             elif role == 'Viewport':
-                self.viewports.append(Viewport.from_element(child))
-                valid += 1
+                yield Viewport.from_element(child)
+
+    def paste(self, objs):
+        valid = 0
+        for obj in objs:
+            if isinstance(obj, Sprite):
+                self.sprites.append(obj)
+            else:
+                self.add_viewport(obj)
+            valid += 1
         return valid
 
     SEL_PRIM_COLOR = (255, 128, 0)
     SEL_COLOR = (128, 64, 0)
-    def render(self, rs=RenderState.NORMAL):
+    # Name labels hang off the left edge of their sprite by up to this much
+    LABEL_PAD = 400
+    # Where the sprites are whose name labels may land in box, drawn at scale
+    def label_box(self, box, scale):
+        pad = self.LABEL_PAD / scale
+        return (
+            box[0] - pad, min(self.sprites.min_y, box[1]),
+            box[2], max(self.sprites.max_y, box[3]),
+        )
+
+    # Draws from pinned (see Pinned) rather than the live chart for a while
+    @contextlib.contextmanager
+    def drawing(self, pinned):
+        live = self.sprites, self.sprite_batch, self.shown, self.selection
+        self.sprites, self.sprite_batch, self.shown = pinned, pinned.batch, pinned.shown
+        self.selection = [pinned.copies.get(obj, obj) for obj in self.selection]
+        try:
+            yield
+        finally:
+            pinned.shown = self.shown
+            self.sprites, self.sprite_batch, self.shown, self.selection = live
+
+    # Name and grid labels keep to the left and bottom of the view, or of
+    # anchor (see Viewport.anchor) when this is one tile of something bigger
+    def render(self, rs=RenderState.NORMAL, region=None, anchor=None):
+        box = region or self.canvas.view_bounds
+        if anchor is None:
+            anchor = self.canvas.origin
         self.canvas.clear()
         if not self.grid_fore:
-            self.render_grid()
-        x = 0.0
-        self.min_y = min((spr.y * spr.scale for spr in self.sprites), default=0)
-        if self.min_y < self.canvas.origin.y:
-            self.min_y = self.canvas.origin.y
-        for i, spr in enumerate(self.sprites):
-            nx = spr.draw(self.canvas, x, self)
-            if spr in self.selection:
-                col = self.SEL_COLOR
-                if spr is self.primary_selection:
-                    col = self.SEL_PRIM_COLOR
-                spr.box(self.canvas, x, col)
-            x = nx
-        if rs != RenderState.IMAGE:
-            for vp in self.viewports:
-                vp.draw(self.canvas, vp in self.selection)
+            with self.canvas.layer(('grid', rs)):
+                self.render_grid(rs, anchor.x)
+        self.min_y = self.sprites.min_y
+        if self.min_y < anchor.y:
+            self.min_y = anchor.y
+        # Only what overlaps the region is placed and left visible in the batch
+        shown = self.sprites.query_rect(box)[::-1]
+        moved = len(shown) != len(self.shown)
+        keep = set(shown)
+        for spr in self.shown:
+            if spr not in keep and spr in self.sprites:
+                spr.sprite.visible = False
+                moved = True
+        for spr in shown:
+            if spr.sprite.batch is not self.sprite_batch:
+                spr.attach(self.sprite_batch, self.layer_group(0))
+                moved = True
+            if not spr.sprite.visible:
+                spr.sprite.visible = True
+                moved = True
+            moved |= spr.place(spr.x)
+        if moved:
+            self.relayer(shown)
+        self.shown = keep
+        self.canvas.draw_batch(self.sprite_batch)
+        with self.canvas.layer(('overlay', rs)):
+            labeled = self.sprites.query_rect(self.label_box(box, self.canvas.scale))
+            for spr in labeled:
+                spr.draw(self.canvas, self)
+                if spr in self.selection:
+                    col = self.SEL_COLOR
+                    if spr is self.primary_selection:
+                        col = self.SEL_PRIM_COLOR
+                    spr.box(self.canvas, spr.x, col)
+            vps = []
+            if rs != RenderState.IMAGE:
+                vps = self.vp_index.query_rect(box)
+                for vp in vps:
+                    vp.draw(self.canvas, vp in self.selection)
+        self.cull_stats[rs] = {
+            'sprites': (len(shown), len(self.sprites) - len(shown)),
+            'labels': (len(labeled), len(self.sprites) - len(labeled)),
+            'viewports': (len(vps), len(self.viewports) - len(vps)),
+        }
         if self.grid_fore:
-            self.render_grid()
+            with self.canvas.layer(('grid', rs)):
+                self.render_grid(rs, anchor.x)
         if rs != RenderState.IMAGE:
-            self.render_mouse()
-            self.render_hud()
+            with self.canvas.layer(('hud', rs)):
+                self.render_mouse()
+                self.render_hud()
+            self.update_residency()
+
+    # Renders viewports (PNG ones a tile at a time) while earlier tiles are
+    # still being read back and encoded. Returns a job (see Jobs) that yields
+    # progress after every tile and returns the Exports once everything is on
+    # disk. What the viewports show is pinned here, before the job starts.
+    ENCODE_AHEAD = 8
+    def render_viewports(self, viewports):
+        viewports = [vp for vp in viewports if not vp.invalid]
+        pinned = Pinned(self.sprites, [
+            self.label_box(vp.bounds, vp.scale) for vp in viewports
+        ])
+        return self.render_pinned(viewports, pinned)
+
+    def render_pinned(self, viewports, pinned):
+        tile = Viewport.tile_size()
+        total = sum(
+            len(cols) for vp in viewports if vp.streamed
+            for _, _, cols in vp.bands(tile)
+        ) + sum(1 for vp in viewports if not vp.streamed)
+        count = 0
+        done = []
+        tex = ring = None
+        exports = []
+        try:
+            for vp in viewports:
+                if not vp.streamed:
+                    exp = Export(vp)
+                    with self.drawing(pinned):
+                        vp.render_whole(self)
+                    exp.end = time.perf_counter()
+                    exp.render_time = exp.end - exp.start
+                    done.append(exp)
+                    count += 1
+                    yield count / total
+            viewports = [vp for vp in viewports if vp.streamed]
+            if not viewports:
+                return done
+
+            pool = encoders()
+            tex = pyglet.image.Texture.create(tile, tile)
+            ring = Readback(4 * tile * tile)
+            ahead = collections.deque()
+            for vp in viewports:
+                exp = Export(vp, pool, ahead)
+                exports.append(exp)
+                bands = list(vp.bands(tile))
+                exp.bands_left = len(bands)
+                anchor = vp.anchor
+                for py, h, cols in bands:
+                    band = Band(exp.size.x, h, len(cols))
+                    for px, w in cols:
+                        start = time.perf_counter()
+                        with Viewport.target(self, tex), self.drawing(pinned):
+                            vp.render_tile(self, px, py, w, h, anchor)
+                            ring.start(w, h, functools.partial(exp.take, band, px, w))
+                        exp.render_time += time.perf_counter() - start
+                        # Don't let encoding fall too far behind
+                        while len(ahead) > self.ENCODE_AHEAD:
+                            yield ahead.popleft()
+                        count += 1
+                        yield count / total
+            ring.close()
+            ring = None
+            while ahead:
+                yield ahead.popleft()
+        except BaseException:
+            for exp in exports:
+                exp.abort()
+            raise
+        finally:
+            # Once only, and without handing tiles to aborted exports
+            if ring is not None:
+                ring.close(flush=False)
+            if tex is not None:
+                tex.delete()
+            pinned.delete()
+        return done + exports
+
+    # Sprites past this many viewboxes away from the view are "far"
+    EVICT_MARGIN = 1
+    EVICT_AFTER = 30.0
+    EVICT_CHECK = 5.0
+    def near_bounds(self):
+        x0, y0, x1, y1 = self.canvas.view_bounds
+        mw, mh = self.EVICT_MARGIN * (x1 - x0), self.EVICT_MARGIN * (y1 - y0)
+        return (x0 - mw, y0 - mh, x1 + mw, y1 + mh)
+
+    # Only looks at what's on or near the screen, and sprites still loading
+    def update_residency(self):
+        now = time.monotonic()
+        for spr in self.sprites.query_rect(self.near_bounds()):
+            spr.last_seen = now
+        for spr in self.sprites.query_rect(self.canvas.view_bounds):
+            if not spr.loaded:
+                spr.request_load(self.wake)
+                if spr.pending is not None:
+                    self.loading.add(spr)
+        for spr in list(self.loading):
+            spr.poll_load()
+            if spr.pending is None:
+                self.loading.discard(spr)
+
+    # On a timer: lets go of images that have been far off screen for a while
+    def evict_far(self, dt):
+        now = time.monotonic()
+        for spr in self.sprites.query_rect(self.near_bounds()):
+            spr.last_seen = now
+        for spr in [spr for spr in Sprite.LOADED if now - spr.last_seen > self.EVICT_AFTER]:
+            spr.unload()
+
+    def ensure_loaded(self, box):
+        needed = [spr for spr in self.sprites.query_rect(box) if not spr.loaded]
+        for spr in needed:
+            spr.request_load()
+        for spr in needed:
+            spr.load()
+
+    # Safe to call from any thread; makes the event loop come around and draw
+    def wake(self):
+        pyglet.app.platform_event_loop.post_event(self.canvas.disp, 'on_wake')
+
+    def ev_wake(self):
+        self.jobs.schedule()
+        self.invalidate()
+
+    def layer_group(self, layer):
+        while len(self.sprite_layers) <= layer:
+            self.sprite_layers.append(pyglet.graphics.OrderedGroup(
+                len(self.sprite_layers), self.canvas.camera,
+            ))
+        return self.sprite_layers[layer]
+
+    # Sprites are drawn in one batch, but later sprites must still cover the
+    # earlier ones they overlap. Each sprite goes one layer above everything
+    # before it that it overlaps; sprites within a layer never overlap, so the
+    # batch is free to group them by texture (and so by filter).
+    def relayer(self, sprites):
+        layers = []
+        reach = []
+        for i, spr in enumerate(sprites):
+            x0, x1 = spr.x, spr.x + spr.width
+            layer = 0
+            j = i - 1
+            while j >= 0 and reach[j] > x0:
+                o = sprites[j]
+                if o.x < x1 and o.x + o.width > x0:
+                    layer = max(layer, layers[j] + 1)
+                j -= 1
+            layers.append(layer)
+            reach.append(max(x1, reach[-1]) if reach else x1)
+            spr.attach(self.sprite_batch, self.layer_group(layer))
 
     PIX_GRID_COLOR = (255, 255, 255)
     REAL_GRID_COLOR = (255, 255, 0)
     ORIGIN_WIDTH = 3
-    def render_grid(self):
+    def render_grid(self, rs=RenderState.NORMAL, left=None):
         vb = self.canvas.viewbox
-        rvb = Rect(
-            *(i / self.ppu for i in (vb.x, vb.y, vb.w, vb.h))
-        )
-        r = rvb if self.real_units else vb
+        if left is None:
+            left = vb.x
+        per = self.ppu if self.real_units else 1
         col = self.REAL_GRID_COLOR if self.real_units else self.PIX_GRID_COLOR
+        unit = self.unit if self.real_units else "px"
 
-        for y in steps(r.y, r.h):
-            vy = y * self.ppu if self.real_units else y
-            w = self.ORIGIN_WIDTH if abs(y) <= 0.001 else 1
-            self.canvas.draw_line(
-                Vec2(vb.x, vy), Vec2(vb.x + vb.w, vy),
-                color = col, width = w,
-            )
+        grid = self.grids.get(rs)
+        if grid is None:
+            grid = self.grids[rs] = Grid(self.canvas.current, self.ORIGIN_WIDTH)
+        grid.update(vb, per, col)
+
+        for y in grid.ys(vb):
             self.canvas.draw_text(
-                f'{y:.3f}{self.unit if self.real_units else "px"}',
-                Vec2(vb.x, vy),
+                f'{y:.3f}{unit}',
+                Vec2(left, y * per),
                 color = col,
             )
 
-        for x in steps(r.x, r.w):
-            vx = x * self.ppu if self.real_units else x
-            w = self.ORIGIN_WIDTH if abs(x) <= 0.001 else 1
-            self.canvas.draw_line(
-                Vec2(vx, vb.y), Vec2(vx, vb.y + vb.h),
-                color = col, width = w,
-            )
+        for x in grid.xs(vb):
             self.canvas.draw_text(
-                f'{x:.3f}{self.unit if self.real_units else "px"}',
-                Vec2(vx, 0),
+                f'{x:.3f}{unit}',
+                Vec2(x * per, 0),
                 color = col,
             )
 
     def hit_test(self, spt, cpt):
         print(f'hit {cpt}')
-        for vp in self.viewports:
+        slack = Viewport.SLACK / self.canvas.scale
+        near = (cpt.x - slack, cpt.y - slack, cpt.x + slack, cpt.y + slack)
+        for vp in self.vp_index.query_rect(near):
             if vp.contains(self.canvas, spt, cpt):
                 return vp
-        for spr in reversed(self.sprites):
-            if spr.contains(self.canvas, spt, cpt):
-                return spr
+        # Later sprites are drawn over earlier ones, so they're hit first
+        for spr in self.sprites.query_point(cpt):
+            return spr
         return None
 
     @property
@@ -925,9 +4150,13 @@ class App:
             lines.extend([
                 f'Scale: {self.ppu}px/{self.unit}',
             ])
+        stats = self.cull_stats.get(RenderState.NORMAL)
+        if stats is not None:
+            drawn, culled = stats['sprites']
+            lines.append(f'Drawn: {drawn}/{drawn + culled} sprites')
         if self.selection_is(Sprite):
             spr = self.primary_selection
-            sw, sh = spr.sprite.width, spr.sprite.height
+            sw, sh = spr.width, spr.height
             ref = None
             if spr.refy is not None:
                 ry = spr.scale * spr.refy
@@ -944,7 +4173,7 @@ class App:
                 f'Asset: {spr.asset!r}',
                 f'Scale: {spr.scale:.3f}',
                 f'Y-offset: {spr.y:.3f}',
-                f'Rendered X: {spr.lastx:.3f}',
+                f'Rendered X: {spr.x:.3f}',
                 f'Overlap: {spr.olap:.3f}',
                 f'Pixel Size: {sw:.3f},{sh:.3f}',
                 f'Ref: {ref}',
@@ -961,6 +4190,11 @@ class App:
                 f'Render Size: {rs.x} x {rs.y} px',
                 f'Scale: {vp.scale}',
             ])
+        if self.report is not None and self.report[0] == self.message:
+            lines.extend(self.report[1])
+        if self.jobs:
+            lines.extend(job.status for job in self.jobs)
+            lines.append('(c to cancel)')
         if len(self.selection) > 1:
             sprites = list(self.each_selected(Sprite))
             viewports = list(self.each_selected(Viewport))
@@ -982,7 +4216,7 @@ class App:
 
     def ev_key_press(self, key, mod):
         self.mods = mod | mod_for(key)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.KEYDOWN,
             key=key,
             mod=mod,
@@ -990,7 +4224,7 @@ class App:
 
     def ev_key_release(self, key, mod):
         self.mods = mod & ~mod_for(key)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.KEYUP,
             key=key,
             mod=mod,
@@ -998,7 +4232,7 @@ class App:
 
     def ev_mouse_motion(self, x, y, dx, dy):
         self.mpos = Vec2(x, y)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.MOUSEMOTION,
             pos=self.mpos,
         ))
@@ -1006,7 +4240,7 @@ class App:
     def ev_mouse_drag(self, x, y, dx, dy, button, mods):
         self.mods = mods
         self.mpos = Vec2(x, y)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.MOUSEMOTION,
             pos=self.mpos,
         ))
@@ -1014,7 +4248,7 @@ class App:
     def ev_mouse_scroll(self, x, y, sx, sy):
         self.mpos = Vec2(x, y)
         if sy != 0:
-            self.keystate(Event(
+            self.dispatch(Event(
                 type=pygame.MOUSEBUTTONDOWN,
                 pos=self.mpos,
                 mod=0,
@@ -1024,7 +4258,7 @@ class App:
     def ev_mouse_press(self, x, y, button, mods):
         self.mods = mods
         self.mpos = Vec2(x, y)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.MOUSEBUTTONDOWN,
             pos=self.mpos,
             button=button,
@@ -1034,7 +4268,7 @@ class App:
     def ev_mouse_release(self, x, y, button, mods):
         self.mods = mods
         self.mpos = Vec2(x, y)
-        self.keystate(Event(
+        self.dispatch(Event(
             type=pygame.MOUSEBUTTONUP,
             pos=self.mpos,
             button=button,
@@ -1044,6 +4278,7 @@ class App:
     def ev_text(self, text):
         if self.capture:
             self.buffer += text
+            self.invalidate()
 
     def ev_text_motion(self, motion):
         if self.capture:
@@ -1074,13 +4309,7 @@ class App:
             index = self.sprites.index(spr)
         except ValueError:
             return
-        place = index + dx
-        if place < 0:
-            place = 0
-        if place > len(self.sprites):
-            place = len(self.sprites)
-        del self.sprites[index]
-        self.sprites.insert(place, spr)
+        self.sprites.move(spr, index + dx)
 
     def ks_default(self, ev):
         if ev.type == pygame.KEYDOWN:
@@ -1126,11 +4355,29 @@ class App:
                 else:
                     source = self.viewports
                     msg = f'Rendered all viewports in {{}}s'
+                # Rendered from copies (and the sprites from Pinned ones), so
+                # they can be edited in the meantime
+                source = [Viewport(vp.name, Rect(vp.rect), vp.scale) for vp in source]
                 start = time.perf_counter()
-                for vp in source:
-                    vp.render(self)
-                end = time.perf_counter()
-                self.message = msg.format(f'{end - start:.3f}')
+                def rendered(exports):
+                    end = time.perf_counter()
+                    pixels = sum(exp.pixels for exp in exports)
+                    self.message = msg.format(f'{end - start:.3f}') + f', {si(pixels / (end - start))}px/s'
+                    self.report = (self.message, [exp.report() for exp in exports])
+                    for line in self.report[1]:
+                        print(line)
+                self.jobs.start('Rendering', self.render_viewports(source), rendered)
+            elif ev.key == key.C:
+                if self.jobs:
+                    self.jobs.cancel_all()
+                else:
+                    self.message = 'Nothing to cancel'
+            elif ev.key == key.Z and ev.mod & key.MOD_ACCEL:
+                if ev.mod & key.MOD_SHIFT:
+                    n, what = self.journal.redo(), 'redo'
+                else:
+                    n, what = self.journal.undo(), 'undo'
+                self.message = f'{what.title()}: {n} changes' if n else f'Nothing to {what}'
             elif ev.key == key.Z:
                 if self.selection_has(Sprite):
                     self.keystate = self.ks_reference
@@ -1175,29 +4422,33 @@ class App:
                 self.message = 'Click origin'
             elif ev.key == key.Y:
                 save = self.export(self.selection)
-                clip_copy(ET.tostring(save.getroot(), 'unicode'))
+                if self.clip is not None:
+                    self.clip.release()
+                self.clip = Clip(ET.tostring(save.getroot(), 'unicode'), self.selection)
                 self.message = f'Exported {len(self.selection)} objects'
             elif ev.key == key.P:
-                clip = clip_paste()
-                if not clip:
+                clip = None if self.clip is not None and self.clip.current() else clip_paste()
+                if clip is None:
+                    res = self.paste(self.clip.paste())
+                    self.message = f'Pasted {res} objects'
+                elif not clip:
                     self.message = 'No clipboard data'
                 else:
-                    root = ET.fromstring(clip)
-                    res = self.import_(root)
+                    res = self.import_(io.StringIO(clip))
                     self.message = f'Imported {res} objects'
             elif ev.key == key.A:
                 if ev.mod & key.MOD_SHIFT:
-                    fnames = []
+                    writes = {}
                     for spr in self.each_selected(Sprite):
                         fname = os.path.join(
                             os.path.dirname(spr.path),
                             f'{spr.name}.asset',
                         )
-                        fnames.append(fname)
-                        with open(fname, 'w') as f:
-                            f.write(ET.tostring(spr.make_asset(), 'unicode'))
+                        writes[os.path.abspath(fname)] = spr.asset_attrs()
                         spr.asset = fname
-                    self.message = f'Saved asset(s) {", ".join(fnames)}'
+                    msg = f'Saved asset(s) {", ".join(writes)}'
+                    self.jobs.start('Saving assets', wait_all(ASSETS.write_all(writes)),
+                            lambda _: setattr(self, 'message', msg))
                 elif ev.mod & key.MOD_ACCEL:
                     if ev.mod & key.MOD_SHIFT:
                         self.unselect()
@@ -1309,22 +4560,21 @@ class App:
         vp = self.primary_selection
         if ev.type == pygame.MOUSEBUTTONDOWN:
             if ev.button == mouse.RIGHT:
-                vp.rect.w, vp.rect.x = self.undo_state
+                vp.rect = Rect(vp.rect.x, vp.rect.y, *self.undo_state)
             self.keystate = self.ks_default
         elif ev.type == pygame.MOUSEMOTION:
             cpt = self.canvas.unmap_point(ev.pos)
-            vp.rect.w = cpt.x - vp.rect.x
-            vp.rect.h = cpt.y - vp.rect.y
+            vp.rect = Rect(vp.rect.x, vp.rect.y, cpt.x - vp.rect.x, cpt.y - vp.rect.y)
 
     def ks_vp_origin(self, ev):
         vp = self.primary_selection
         if ev.type == pygame.MOUSEBUTTONDOWN:
             if ev.button == mouse.RIGHT:
-                vp.rect.x, vp.rect.y = self.undo_state
+                vp.rect = Rect(*self.undo_state, vp.rect.w, vp.rect.h)
             self.keystate = self.ks_default
         elif ev.type == pygame.MOUSEMOTION:
             cpt = self.canvas.unmap_point(ev.pos)
-            vp.rect.x, vp.rect.y = cpt.x, cpt.y
+            vp.rect = Rect(cpt.x, cpt.y, vp.rect.w, vp.rect.h)
 
     def ks_vp_scale(self, ev):
         if ev.type == pygame.MOUSEBUTTONDOWN:
@@ -1357,30 +4607,7 @@ class App:
     def ks_load(self, ev):
         if ev.type == pygame.KEYDOWN:
             if ev.key == key.ENTER:
-                try:
-                    spr = Sprite.from_asset(self.buffer)
-                except (FileNotFoundError, ET.ParseError):
-                    try:
-                        spr = Sprite(
-                            pyglet.image.load(self.buffer),
-                            self.buffer,
-                        )
-                    except (FileNotFoundError, pyglet.image.ImageDecodeException) as e:
-                        traceback.print_exc()
-                        self.message = repr(e)
-                        self.keystate = self.ks_default
-                        return
-                if self.selection_is(Sprite):
-                    try:
-                        self.sprites.insert(
-                            self.sprites.index(self.primary_selection),
-                            spr,
-                        )
-                    except ValueError:
-                        self.sprites.append(spr)
-                else:
-                    self.sprites.append(spr)
-                self.set_selection(spr)
+                self.jobs.start(f'Loading {self.buffer}', self.load_job(self.buffer), self.place_loaded)
                 self.keystate = self.ks_default
                 self.message = ''
                 self.capture = False
@@ -1393,13 +4620,87 @@ class App:
                         self.buffer = pfx
         self.message = f'Load: {self.buffer}{CURSOR}'
 
+    # Decodes an image (or an asset's image) on the pool, then makes a Sprite
+    def load_job(self, path):
+        try:
+            img, params = Sprite.asset_params(path)
+        except (FileNotFoundError, ET.ParseError):
+            img, params = path, {}
+        info = INFO.get(img)
+        if info is not None:
+            return Sprite.from_params(img, info['size'], lazy=True, **params)
+        pending = IMAGES.prefetch(img, params.get('avg_color') is None)
+        if pending is not None:
+            yield pending
+        return Sprite(IMAGES.acquire(img), img, **params)
+
+    def place_loaded(self, spr):
+        if self.selection_is(Sprite):
+            try:
+                self.sprites.insert(
+                    self.sprites.index(self.primary_selection),
+                    spr,
+                )
+            except ValueError:
+                self.sprites.append(spr)
+        else:
+            self.sprites.append(spr)
+        self.set_selection(spr)
+        if self.keystate == self.ks_default:
+            self.journal.commit()
+
+    # Streams the chart into a temp file next to path a batch of sprites at a
+    # time, then renames it over path once the assets are written; an edit
+    # partway through starts it over. Returns None if path is already current.
+    def save_job(self, path):
+        if self.saved == (path, self.revision, self.view) and os.path.exists(path):
+            return None
+        while True:
+            rev, view = self.revision, self.view
+            writes = {}
+            fd, tmp = tempfile.mkstemp(
+                prefix=f'.{os.path.basename(path)}.', suffix='.tmp',
+                dir=os.path.dirname(os.path.abspath(path)),
+            )
+            try:
+                with open(fd, 'w', encoding='utf-8') as f:
+                    f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                    for progress in self.write_chart(SVGWriter(f), writes):
+                        yield progress
+                        if self.revision != rev:
+                            break
+                if self.revision != rev:
+                    os.remove(tmp)
+                    continue
+                yield from wait_all(ASSETS.write_all(writes))
+                # mkstemp files are private; keep what was there before
+                mode = os.stat(path).st_mode if os.path.exists(path) else 0o644
+                os.chmod(tmp, mode & 0o777)
+                os.replace(tmp, path)
+                stamp = file_stamp(path)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            self.saved = (path, rev, view)
+            # The journal carries on from what was written, if that's still
+            # what's here; otherwise it can't say what to replay onto it
+            self.journal.attach(
+                path if self.revision == rev else None,
+                recover=False, keep=self.revision != rev,
+            )
+            # Only if the model is still what was just written
+            if self.SIDECAR and self.revision == rev:
+                yield encoders().submit(write_sidecar, path, self.snapshot(path, stamp))
+            return path
+
     def ks_delete(self, ev):
         if ev.type == pygame.KEYDOWN:
             if ev.key == key.Y:
                 if self.selection_is(Sprite):
                     self.sprites.remove(self.primary_selection)
                 elif self.selection_is(Viewport):
-                    self.viewports.remove(self.primary_selection)
+                    self.remove_viewport(self.primary_selection)
                 self.unselect()
             self.keystate = self.ks_default
             self.message = ''
@@ -1407,8 +4708,9 @@ class App:
     def ks_write(self, ev):
         if ev.type == pygame.KEYDOWN:
             if ev.key == key.ENTER:
-                et = self.save_tree()
-                et.write(self.buffer, 'unicode')
+                self.jobs.start(f'Saving {self.buffer}', self.save_job(self.buffer),
+                        lambda path: setattr(self, 'message',
+                            'No changes to save' if path is None else f'Saved {path}'))
                 self.keystate = self.ks_default
                 self.message = ''
                 self.capture = False
@@ -1426,18 +4728,18 @@ class App:
             cpt = self.canvas.unmap_point(ev.pos)
             if self.origin is not None:
                 r = self.work_vp.rect
-                r.w, r.h = cpt.x - r.x, cpt.y - r.y
+                self.work_vp.rect = Rect(r.x, r.y, cpt.x - r.x, cpt.y - r.y)
         elif ev.type == pygame.MOUSEBUTTONDOWN:
             if ev.button == mouse.RIGHT:
                 if self.work_vp is not None:
-                    self.viewports.remove(self.work_vp)
+                    self.remove_viewport(self.work_vp)
                 self.keystate = self.ks_default
             elif ev.button == mouse.LEFT:
                 cpt = self.canvas.unmap_point(ev.pos)
                 if self.origin is None:
                     self.origin = cpt
                     self.work_vp = Viewport('unnamed', Rect(cpt.x, cpt.y, 1, 1))
-                    self.viewports.append(self.work_vp)
+                    self.add_viewport(self.work_vp)
                     self.message = 'Click opposite'
                 else:
                     self.capture = True
@@ -1504,15 +4806,96 @@ class App:
                 mstr = f': {mode}'
             self.message = f'Filter({which}){mstr}'
 
+# Times PNG encoding of a synthetic w x h image: one zlib stream (as a plain
+# encoder would) against strips deflated in parallel, at a few levels.
+def bench_png(w, h, band=256):
+    import tempfile
+    base = bytes(
+        0 if (i // 8192) % 3 == 0 else (i * i >> 7) & 0xff
+        for i in range(4 * w)
+    )
+    rows = [base[4 * k:] + base[:4 * k] for k in range(band)]
+    print(f'{w} x {h} RGBA, {si(4 * w * h)}B raw, {os.cpu_count()} CPUs')
+    fd, path = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    try:
+        for label, level, pool in (
+            ('serial', PNGWriter.LEVEL, None),
+            ('parallel', PNGWriter.LEVEL, deflaters()),
+            ('serial', 1, None),
+            ('parallel', 1, deflaters()),
+            ('parallel', 0, deflaters()),
+        ):
+            start = time.perf_counter()
+            with PNGWriter(path, w, h, level, pool) as png:
+                for top in range(0, h, band):
+                    png.write_rows(rows[:min(band, h - top)])
+            t = time.perf_counter() - start
+            print(f'{label:>8} level {level}: {t:7.3f}s, {si(4 * w * h / t)}B/s, {si(os.path.getsize(path))}B')
+    finally:
+        os.remove(path)
+
 def main():
-    import sys
+    parser = argparse.ArgumentParser(description='Makes size charts.')
+    parser.add_argument('file', nargs='?', help='Chart to load')
+    parser.add_argument('--image-budget', type=float, metavar='MiB',
+            default=ImageCache.BUDGET / (1 << 20),
+            help='Memory to keep unused decoded images and textures around in (default %(default)d)')
+    parser.add_argument('--fps-cap', type=float, metavar='FPS',
+            default=App.INTERACTIVE_FPS,
+            help='Most redraws per second while dragging, 0 for no limit (default %(default)d)')
+    parser.add_argument('--png-level', type=int, choices=range(10), metavar='0-9',
+            default=PNGWriter.LEVEL,
+            help='Compression level of rendered PNGs (default %(default)d)')
+    parser.add_argument('--fast', dest='png_level', action='store_const', const=1,
+            help='Compress rendered PNGs as little as is still useful (level 1), for quick test renders')
+    parser.add_argument('--bench-png', metavar='WxH',
+            help='Time PNG encoding of a WxH image and exit')
+    parser.add_argument('--convert', nargs='+', metavar='FILE',
+            help='Turn .rgba, .pam, .ppm or .qoi renders into PNGs next to them and exit')
+    parser.add_argument('--warm-cache', nargs='+', metavar='DIR',
+            help='Read every image under DIR into the image info cache and exit')
+    parser.add_argument('--prune-cache', action='store_true',
+            help='Trim the image info cache to --cache-budget and exit')
+    parser.add_argument('--cache-budget', type=float, metavar='MiB',
+            default=InfoCache.BUDGET / (1 << 20),
+            help='Disk space for the image info cache in %s (default %%(default)d)' % INFO.root)
+    parser.add_argument('--undo-memory', type=float, metavar='MiB',
+            default=Journal.BUDGET / (1 << 20),
+            help='Memory to keep undo history in (default %(default)d)')
+    parser.add_argument('--sidecar', action='store_true',
+            help='Keep a CHART.cache snapshot next to the chart to reopen it without parsing it')
+    args = parser.parse_args()
+    IMAGES.budget = int(args.image_budget * (1 << 20))
+    App.INTERACTIVE_FPS = args.fps_cap
+    App.SIDECAR = args.sidecar
+    Journal.BUDGET = int(args.undo_memory * (1 << 20))
+    INFO.budget = int(args.cache_budget * (1 << 20))
+    if args.warm_cache is not None:
+        INFO.warm(args.warm_cache)
+        return
+    if args.prune_cache:
+        INFO.prune()
+        return
+    PNGWriter.LEVEL = args.png_level
+    if args.bench_png is not None:
+        w, h = (int(i) for i in args.bench_png.lower().split('x'))
+        bench_png(w, h)
+        return
+    if args.convert is not None:
+        convert_to_png(args.convert)
+        return
+
     pygame.init()
     pygame.display.set_caption('sizechart')
     app = App(pyglet.window.Window(resizable=True))
-    if len(sys.argv) > 1:
-        et = ET.ElementTree(file=sys.argv[1])
-        app.load_tree(et.getroot())
-        app.default_file = sys.argv[1]
+    if args.file is not None:
+        app.load_chart(args.file)
+        app.default_file = args.file
+        app.saved = (args.file, app.revision, app.view)
+        recovered = app.journal.attach(args.file)
+        if recovered:
+            app.message = f'Recovered {recovered} unsaved edits (Ctrl+Z undoes them)'
     clock = pygame.time.Clock()
     # begin test code
     #path = "images/Grissess_Full_transparent.png"
@@ -1522,6 +4905,11 @@ def main():
     #app.selection = 1
 
     pyglet.app.run()
+    # Let queued info records land before the index is written
+    if _encoders is not None:
+        _encoders.shutdown()
+    INFO.close()
+    app.journal.close(keep=app.saved is None or app.saved[1] != app.revision)
 
 if __name__ == '__main__':
     main()